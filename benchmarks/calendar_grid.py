@@ -0,0 +1,54 @@
+"""
+Times building the month grids for a 24-month nav_calendars, with the month
+skeletons memoised (as templatetags/calendar.py does), and with the skeleton
+cache cleared before each render, so that every month is built from scratch.
+
+    python benchmarks/calendar_grid.py
+
+Needs Django and eventtools' requirements (including glamkit-convenient, for
+eventtools.conf), but not a database: the occurrences are a list, rather than
+a queryset. No results are recorded here, as it hasn't yet been run with them
+all installed. (It isn't called calendar.py,
+which would hide the standard library's calendar module from scripts run from
+this directory.)
+"""
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure()
+
+from eventtools.templatetags import calendar as calendar_tags
+
+class FakeOccurrence(object):
+    def __init__(self, start):
+        self.start = start
+
+def occurrences(months=24):
+    first = datetime.datetime(2012, 1, 1, 10, 30)
+    return [FakeOccurrence(first + datetime.timedelta(days=d))
+        for d in range(0, months * 30, 2)]
+
+def render(occurrence_list):
+    return calendar_tags.nav_calendars({}, occurrence_list, occurrence_list[0])
+
+def render_uncached(occurrence_list):
+    calendar_tags._month_cache.clear()
+    return render(occurrence_list)
+
+def main(repeat=20):
+    occurrence_list = occurrences()
+    render(occurrence_list)
+    t_uncached = min(timeit.repeat(lambda: render_uncached(occurrence_list),
+        number=1, repeat=repeat))
+    t_cached = min(timeit.repeat(lambda: render(occurrence_list),
+        number=1, repeat=repeat))
+    print("24-month nav_calendars: month grids built each time %.2fms, memoised %.2fms (%.1fx)" % (
+        t_uncached * 1000, t_cached * 1000, t_uncached / t_cached))
+
+if __name__ == '__main__':
+    main()
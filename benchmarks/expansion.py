@@ -0,0 +1,58 @@
+"""
+Compares eventtools.utils.expansion with stepping a dateutil rrule, as
+GeneratorModel used to, over multi-year horizons.
+
+    python benchmarks/expansion.py
+
+Needs NumPy and python-dateutil, but not Django.
+"""
+import datetime
+import itertools
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'eventtools', 'utils'))
+import expansion
+
+from dateutil import rrule
+
+FREQUENCIES = {
+    'DAILY': rrule.DAILY,
+    'WEEKLY': rrule.WEEKLY,
+    'MONTHLY': rrule.MONTHLY,
+}
+
+RULES = [
+    ('DAILY', {}),
+    ('WEEKLY', {}),
+    ('WEEKLY', {'byweekday': [1, 3, 5]}),
+    ('MONTHLY', {'bymonthday': [1, 15]}),
+]
+
+def dateutil_starts(frequency, params, dtstart, until):
+    rule = rrule.rrule(FREQUENCIES[frequency], dtstart=dtstart, **params)
+    return list(itertools.takewhile(lambda d: d <= until, rule))
+
+def main(repeat=5):
+    dtstart = datetime.datetime(2012, 1, 2, 10, 30)
+    for years in (1, 5, 20):
+        until = datetime.datetime.combine(
+            dtstart.date() + datetime.timedelta(days=365 * years),
+            datetime.time.max)
+        for frequency, params in RULES:
+            fast = expansion.expand_datetimes(frequency, params, dtstart, until)
+            assert fast == dateutil_starts(frequency, params, dtstart, until)
+
+            t_dateutil = min(timeit.repeat(
+                lambda: dateutil_starts(frequency, params, dtstart, until),
+                number=1, repeat=repeat))
+            t_numpy = min(timeit.repeat(
+                lambda: expansion.expand(frequency, params, dtstart, until),
+                number=1, repeat=repeat))
+            print("%2d years %-8s %-28s %6d starts: dateutil %8.2fms, numpy %6.2fms (%5.1fx)" % (
+                years, frequency, params, len(fast),
+                t_dateutil * 1000, t_numpy * 1000, t_dateutil / t_numpy))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Compares writing an iCalendar feed with eventtools.utils.ics with building and
+serializing it with vobject, as OccurrenceModel.as_icalendar does.
+
+    python benchmarks/ics.py
+
+Needs vobject and python-dateutil, but not Django. With vobject 0.9.9 and
+python-dateutil 2.9 on Python 2.7, the ics writer was 35-65x faster, eg
+10,000 occurrences in about 0.4s rather than 19-22s.
+"""
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'eventtools', 'utils'))
+import ics
+
+from vobject import iCalendar
+from vobject.icalendar import utc
+
+def occurrences(n):
+    start = datetime.datetime(2012, 1, 2, 10, 30, tzinfo=utc)
+    for i in range(n):
+        dtstart = start + datetime.timedelta(hours=i)
+        yield {
+            'uid': u"occurrence-%d@example.com" % i,
+            'dtstart': dtstart,
+            'dtend': dtstart + datetime.timedelta(hours=1),
+            'summary': u"Event %d: talks, tours; and more" % i,
+            'description': u"A longer description of the event, which is long enough to need folding. " * 3,
+            'url': u"http://example.com/events/event-%d/%d/" % (i, i),
+            'location': u"Gallery %d" % (i % 10),
+            'geo': u"151.2;-33.9",
+        }
+
+def with_vobject(items, dtstamp):
+    ical = iCalendar()
+    ical.add('X-WR-CALNAME').value = u"Events list"
+    ical.add('X-WR-CALDESC').value = u"Events listing"
+    ical.add('method').value = 'PUBLISH'
+    for item in items:
+        vevent = ical.add('vevent')
+        vevent.add('uid').value = item['uid']
+        vevent.add('dtstamp').value = dtstamp
+        vevent.add('dtstart').value = item['dtstart']
+        vevent.add('dtend').value = item['dtend']
+        vevent.add('summary').value = item['summary']
+        vevent.add('description').value = item['description']
+        vevent.add('url').value = item['url']
+        vevent.add('location').value = item['location']
+        vevent.add('geo').value = item['geo']
+    return ical.serialize()
+
+def with_ics(items, dtstamp):
+    return "".join(
+        [ics.calendar_head(u"Events list", u"Events listing")] +
+        [ics.vevent(dtstamp=dtstamp, **item) for item in items] +
+        [ics.calendar_tail()]
+    )
+
+def main(repeat=3):
+    dtstamp = datetime.datetime(2012, 1, 1, tzinfo=utc)
+    for n in (100, 1000, 10000):
+        items = list(occurrences(n))
+        t_vobject = min(timeit.repeat(
+            lambda: with_vobject(items, dtstamp), number=1, repeat=repeat))
+        t_ics = min(timeit.repeat(
+            lambda: with_ics(items, dtstamp), number=1, repeat=repeat))
+        print("%6d occurrences: vobject %9.2fms, ics %7.2fms (%5.1fx)" % (
+            n, t_vobject * 1000, t_ics * 1000, t_vobject / t_ics))
+
+if __name__ == '__main__':
+    main()
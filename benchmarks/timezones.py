@@ -0,0 +1,52 @@
+"""
+Compares converting a year of hourly occurrences' naive local starts and ends
+to UTC one at a time, as OccurrenceModel.as_icalendar does, with
+eventtools.utils.timezones.to_utc_many.
+
+    python benchmarks/timezones.py [zone]
+
+Needs python-dateutil, but not Django.
+"""
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'eventtools', 'utils'))
+import timezones
+
+from dateutil.tz import gettz, tzutc
+
+utc = tzutc()
+
+def one_at_a_time(datetimes, zone_name):
+    result = []
+    for dt in datetimes:
+        tz = gettz(zone_name)
+        result.append(dt.replace(tzinfo=tz).astimezone(utc))
+    return result
+
+def one_at_a_time_cached_zone(datetimes, zone_name):
+    tz = timezones.get_zone(zone_name)
+    return [dt.replace(tzinfo=tz).astimezone(utc) for dt in datetimes]
+
+def batched(datetimes, zone_name):
+    return timezones.to_utc_many(datetimes, timezones.get_zone(zone_name))
+
+def main(zone_name='Australia/Sydney', repeat=3):
+    first = datetime.datetime(2012, 1, 1)
+    starts = [first + datetime.timedelta(hours=h) for h in range(365 * 24)]
+    datetimes = starts + [start + datetime.timedelta(minutes=90) for start in starts]
+
+    expected = [dt.replace(tzinfo=None) for dt in one_at_a_time(datetimes, zone_name)]
+    assert batched(datetimes, zone_name) == expected
+
+    print("%d datetimes in %s:" % (len(datetimes), zone_name))
+    baseline = None
+    for f in (one_at_a_time, one_at_a_time_cached_zone, batched):
+        t = min(timeit.repeat(lambda: f(datetimes, zone_name), number=1, repeat=repeat))
+        baseline = baseline or t
+        print("  %-26s %8.2fms (%5.1fx)" % (f.__name__, t * 1000, baseline / t))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -19,7 +19,7 @@ from django.template.defaultfilters import date, time
 
 from utils.diff import generate_diff
 
-from .models import Rule
+from .models import Rule, batched_occurrence_changes
 
 import django
 if django.VERSION[0] == 1 and django.VERSION[1] >= 4:
@@ -43,15 +43,30 @@ class TreeModelChoiceField(forms.ModelChoiceField):
 
 # ADMIN ACTIONS
 def _remove_occurrences(modeladmin, request, queryset):
-    for m in queryset:
-        # if the occurrence was generated, then add it as an exclusion.
-        if m.generated_by is not None:
-            m.event.exclusions.get_or_create(start=m.start)
-        m.delete()
+    with batched_occurrence_changes():
+        for m in queryset:
+            # if the occurrence was generated, then add it as an exclusion.
+            if m.generated_by is not None:
+                m.event.exclusions.get_or_create(start=m.start)
+            m.delete()
 _remove_occurrences.short_description = _("Delete occurrences (and prevent recreation by a repeating occurrence)")
 
+def _occurrences_changed(events):
+    """
+    Tell the given events, one per tree, that their occurrences have changed.
+    Needed after bulk updates and deletes, which bypass the occurrences' own
+    save() and delete().
+    """
+    tree_ids = set()
+    for event in events:
+        if event.tree_id not in tree_ids:
+            tree_ids.add(event.tree_id)
+            event.occurrences_changed()
+
 def _wipe_occurrences(modeladmin, request, queryset):
+    events = list(queryset.events())
     queryset.delete()
+    _occurrences_changed(events)
 _wipe_occurrences.short_description = _("Delete occurrences (but allow recreation by a repeating occurrence)")
 
 def _convert_to_oneoff(modeladmin, request, queryset):
@@ -59,19 +74,27 @@ def _convert_to_oneoff(modeladmin, request, queryset):
         # if the occurrence was generated, then add it as an exclusion.
         if m.generated_by is not None:
             m.event.exclusions.get_or_create(start=m.start)
+    events = list(queryset.events())
     queryset.update(generated_by=None)
+    _occurrences_changed(events)
 _convert_to_oneoff.short_description = _("Make occurrences one-off (and prevent recreation by a repeating occurrence)")
 
 def _cancel(modeladmin, request, queryset):
+    events = list(queryset.events())
     queryset.update(status=settings.OCCURRENCE_STATUS_CANCELLED[0])
+    _occurrences_changed(events)
 _cancel.short_description = _("Make occurrences cancelled")
 
 def _fully_booked(modeladmin, request, queryset):
+    events = list(queryset.events())
     queryset.update(status=settings.OCCURRENCE_STATUS_FULLY_BOOKED[0])
+    _occurrences_changed(events)
 _fully_booked.short_description = _("Make occurrences fully booked")
 
 def _clear_status(modeladmin, request, queryset):
+    events = list(queryset.events())
     queryset.update(status="")
+    _occurrences_changed(events)
 _clear_status.short_description = _("Clear booked/cancelled status")
 
 class OccurrenceAdminForm(forms.ModelForm):
@@ -273,7 +296,7 @@ def EventAdmin(EventModel, SuperModel=MPTTModelAdmin, show_exclusions=False, sho
             self.occurrence_model = EventModel.OccurrenceModel()
 
         def unicode_bold_if_listed(self, obj):
-            if obj.is_listed():
+            if obj._listed_under_id == obj.pk: # from the listing index
                 result = "<span style='font-weight:bold;padding-left:%spx'>%s</span>"
             else:
                 result = "<span style='font-weight:normal;padding-left:%spx'>%s</span>"
@@ -395,6 +418,36 @@ class OccurrenceInlineFormSet(BaseInlineFormSet):
             pass
         super(OccurrenceInlineFormSet, self).__init__(*args, **kwargs)
 
+    def save(self, commit=True):
+        # tell the event its occurrences have changed once, not per form
+        with batched_occurrence_changes():
+            return super(OccurrenceInlineFormSet, self).save(commit=commit)
+
+class GeneratorInlineFormSet(BaseInlineFormSet):
+    """
+    Saves generators without synchronising their occurrences one by one, then
+    resynchronises all the event's generators in one go at the end.
+    """
+    def save_new(self, form, commit=True):
+        obj = super(GeneratorInlineFormSet, self).save_new(form, commit=False)
+        if commit:
+            obj.save(sync=False)
+            form.save_m2m()
+        return obj
+
+    def save_existing(self, form, instance, commit=True):
+        obj = form.save(commit=False)
+        if commit:
+            obj.save(sync=False)
+            form.save_m2m()
+        return obj
+
+    def save(self, commit=True):
+        r = super(GeneratorInlineFormSet, self).save(commit=commit)
+        if commit:
+            self.instance.resync_generators()
+        return r
+
 def OccurrenceInline(OccurrenceModel):
     class _OccurrenceInline(admin.TabularInline):
         model = OccurrenceModel
@@ -414,6 +467,7 @@ def ExclusionInline(ExclusionModel):
 def GeneratorInline(GeneratorModel):
     class _GeneratorInline(admin.TabularInline):
         model = GeneratorModel
+        formset = GeneratorInlineFormSet
         extra = 0
     return _GeneratorInline
     
@@ -0,0 +1,42 @@
+from django.core.management.base import NoArgsCommand
+from django.db import IntegrityError
+from django.db.models import get_models
+
+from eventtools.conf import settings
+from eventtools.models import GeneratorModel
+
+
+class Command(NoArgsCommand):
+    help = "Generates the occurrences of endless generators (those with no " \
+        "repeat_until) up to DEFAULT_GENERATOR_LIMIT from today. Run it " \
+        "regularly, eg daily from cron."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        for model in get_models():
+            if not issubclass(model, GeneratorModel) or model._meta.proxy:
+                continue
+
+            created = 0
+            last_pk = 0
+            while True:
+                # in batches, so that we never hold all the generators
+                batch = list(model._default_manager \
+                    .filter(repeat_until__isnull=True, pk__gt=last_pk) \
+                    .select_related('rule').order_by('pk') \
+                    [:settings.OCCURRENCE_BATCH_SIZE])
+                if not batch:
+                    break
+                for generator in batch:
+                    # each generator is extended in its own transaction.
+                    try:
+                        created += generator.extend()
+                    except IntegrityError:
+                        # another run has just extended it.
+                        continue
+                last_pk = batch[-1].pk
+
+            if verbosity > 0:
+                self.stdout.write("Created %s occurrences for %s\n" %
+                    (created, model._meta.object_name))
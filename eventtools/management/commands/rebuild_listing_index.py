@@ -0,0 +1,19 @@
+from django.core.management.base import NoArgsCommand
+from django.db.models import get_models
+
+from eventtools.models import EventModel
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the listing index of every event model, eg after " \
+        "adding the index fields, or changing occurrences outside of " \
+        "eventtools (with raw SQL, fixtures, etc.)."
+
+    def handle_noargs(self, **options):
+        for model in get_models():
+            if issubclass(model, EventModel) and not model._meta.proxy:
+                model.rebuild_listing_index()
+                model.touch_occurrences()
+                if int(options.get('verbosity', 1)) > 0:
+                    self.stdout.write("Rebuilt the listing index for %s\n" %
+                        model._meta.object_name)
@@ -1,18 +1,25 @@
-from operator import itemgetter
-
-from django.db import models
+import datetime
+import threading
+import time
+from contextlib import contextmanager
+from operator import itemgetter, or_
+
+from django.core.cache import cache
+from django.db import models, connection
 from django.db.models.base import ModelBase
 from django.db.models.fields import FieldDoesNotExist
-from django.db.models import Count
+from django.db.models import Count, Min, Max, Q
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.template.defaultfilters import urlencode, slugify
+from django.utils.datastructures import SortedDict
 
 from mptt.models import MPTTModel, MPTTModelBase
 from mptt.managers import TreeManager
 
 from eventtools.utils.inheritingdefault import ModelInstanceAwareDefault #TODO: deprecate
 from eventtools.utils.pprint_timespan import pprint_datetime_span, pprint_date_span
+from eventtools.utils.sqldates import time_sql, time_from_db
 from eventtools.conf import settings
 
 class EventQuerySet(models.query.QuerySet):
@@ -22,6 +29,36 @@ class EventQuerySet(models.query.QuerySet):
     # We have to relax this for opening and closing occurrences, as they're 
     # relevant to a particular event.
 
+    _with_listing_summary = False
+
+    def _clone(self, *args, **kwargs):
+        c = super(EventQuerySet, self)._clone(*args, **kwargs)
+        c._with_listing_summary = self._with_listing_summary
+        return c
+
+    def iterator(self):
+        if not self._with_listing_summary:
+            for event in super(EventQuerySet, self).iterator():
+                yield event
+            return
+
+        events = list(super(EventQuerySet, self).iterator())
+        if events:
+            self.model.attach_occurrence_summaries(events)
+        for event in events:
+            yield event
+
+    def with_listing_summary(self):
+        """
+        Returns the events with their occurrence_summary() attached, which is
+        fetched for all of them at once. The summary is what season(),
+        status(), is_finished(), unavailable_status_message() etc. read, so
+        use this for querysets of events that are rendered in a list.
+        """
+        c = self._clone()
+        c._with_listing_summary = True
+        return c
+
     def in_listings(self):
         """
         Returns the events that should be in listings, namely, the top
@@ -32,61 +69,94 @@ class EventQuerySet(models.query.QuerySet):
         Occurrence set, with no repetitions or overlaps. ie, this is probably
         what you want to show in listings.
 
-        Given that the tree is likely to be quite shallow, let's do this breadth-first.
-
-        For each level:
-        * two filter: 1) children of qs having_occurrences and 2) children of qs having_no_occurrences.
-        * 1) is added to result set.
-        * 2) is used as qs for next level
-
-        TODO: For subqueries, this will produce results that are not in the
-        superqueries, because we don't have access to potential missing parents.
-        Maybe this is desired behaviour?
+        This is a single lookup on the listing index (see
+        EventModel.rebuild_listing_index), so events are returned regardless
+        of whether their parents are in this queryset.
         """
-        max_level = self.aggregate(models.Max('level'))['level__max']
-
-        result = self.filter(level=0).having_occurrences()
-        qs = self.filter(level=0).having_no_occurrences()
-
-        for level in range(1, max_level+1):
-            if qs:
-                result |= self.filter(parent__in=qs).having_occurrences()
-                qs = self.filter(parent__in=qs).having_no_occurrences()
-
-        return result
+        return self.filter(_listed_under=models.F('pk'))
 
     def occurrences(self):
         """
         Returns the occurrences for events in this queryset. NB that only
         occurrences attached directly to events, ie not child events, are returned.
         """
-        return self.model.OccurrenceModel().objects\
+        qs = self.model.OccurrenceModel().objects\
             .filter(event__in=self)
+        qs._virtual_events = self # see OccurrenceQuerySet.with_virtual()
+        return qs
                 
+    def exclusions(self):
+        """
+        Returns the exclusions for events in this queryset. NB that only
+        exclusions attached directly to events, ie not child events, are returned.
+        """
+        return self.model.ExclusionModel()._default_manager\
+            .filter(event__in=self)
+
     def opening_occurrences(self):
         """
         Returns the opening occurrences for the events in this queryset.
         """
-        pks = []
-        for e in self:
-            try:
-                pks.append(e.opening_occurrence().id)
-            except AttributeError:
-                pass
-        return self.occurrences().filter(pk__in=pks)
+        return self._extreme_occurrences(Min, min)
         
     def closing_occurrences(self):
         """
         Returns the closing occurrences for the events in this queryset.
         """
-        pks = []
-        for e in self:
-            try:
-                pks.append(e.closing_occurrence().id)
-            except AttributeError:
-                pass
-        return self.occurrences().filter(pk__in=pks)
-                
+        return self._extreme_occurrences(Max, max)
+
+    def _extreme_occurrences(self, aggregate, pick):
+        """
+        Returns the first (with Min, min) or last (with Max, max) occurrence in
+        the listing of each event in this queryset, ie the occurrence that
+        event.opening_occurrence() or event.closing_occurrence() would return.
+
+        Rather than querying each event's listing, this finds the first or
+        last start of every event in the trees of these events, in one grouped
+        query, and rolls them up the trees in memory. Ties between occurrences
+        at the same start are broken by the events' positions in the tree, as in
+        the occurrence ordering (events are ordered by tree_id and lft, and a
+        listing is within one tree).
+        """
+        opts = self.model._mptt_meta
+        tree_id_attr = 'event__%s' % opts.tree_id_attr
+        left_attr = 'event__%s' % opts.left_attr
+        OccurrenceModel = self.model.OccurrenceModel()
+
+        positions = set(self.order_by().values_list(
+            opts.tree_id_attr, opts.left_attr, opts.right_attr
+        ))
+        if not positions:
+            return OccurrenceModel.objects.none()
+
+        extremes = {} # tree_id: [(lft, start, event_id), ...]
+        for row in OccurrenceModel.objects \
+            .filter(**{'%s__in' % tree_id_attr: list(set(p[0] for p in positions))}) \
+            .values('event', tree_id_attr, left_attr) \
+            .annotate(extreme=aggregate('start')) \
+            .order_by():
+            extremes.setdefault(row[tree_id_attr], []).append(
+                (row[left_attr], row['extreme'], row['event'])
+            )
+
+        q = None
+        for tree_id, lft, rght in positions:
+            in_listing = [
+                (start, event_lft, event_id)
+                for event_lft, start, event_id in extremes.get(tree_id, [])
+                if lft <= event_lft <= rght
+            ]
+            if in_listing:
+                start, event_lft, event_id = pick(in_listing)
+                if q is None:
+                    q = Q(event=event_id, start=start)
+                else:
+                    q |= Q(event=event_id, start=start)
+
+        if q is None:
+            return OccurrenceModel.objects.none()
+        return OccurrenceModel.objects.filter(q)
+
     #some simple annotations
     def having_occurrences(self):
         return self.annotate(num_occurrences=Count('occurrences'))\
@@ -112,6 +182,12 @@ class EventTreeManager(TreeManager):
     def occurrences(self, *args, **kwargs):
         return self.get_query_set().occurrences(*args, **kwargs)
 
+    def exclusions(self, *args, **kwargs):
+        return self.get_query_set().exclusions(*args, **kwargs)
+
+    def with_listing_summary(self):
+        return self.get_query_set().with_listing_summary()
+
     def opening_occurrences(self, *args, **kwargs):
         return self.get_query_set().opening_occurrences(*args, **kwargs)
     def closing_occurrences(self, *args, **kwargs):
@@ -204,6 +280,125 @@ class EventModelBase(MPTTModelBase):
 
         return cls
 
+# as in OccurrenceQSFN.available()
+AVAILABLE_STATUSES = ("", None)
+
+# Version stamps are only reset if they fall out of the cache, which just
+# invalidates whatever was cached with them.
+OCCURRENCES_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+class _PendingOccurrenceChanges(threading.local):
+    def __init__(self):
+        self.depth = 0
+        # EventModel: (tree_ids, event pks, tree_ids only to touch)
+        self.changes = {}
+
+_pending_changes = _PendingOccurrenceChanges()
+
+@contextmanager
+def batched_occurrence_changes():
+    """
+    Defers what EventModel.occurrences_changed() does (rebuilding the listing
+    index and changing occurrences_version) to the end of the block, where it
+    is done once for all the trees whose occurrences changed, rather than for
+    every occurrence that is saved or deleted:
+
+        with batched_occurrence_changes():
+            for occurrence in occurrences:
+                occurrence.save()
+
+    If the block raises, the changes are dropped rather than done: the
+    transaction may have been aborted or rolled back.
+    """
+    _pending_changes.depth += 1
+    try:
+        yield
+    except:
+        _pending_changes.depth -= 1
+        if not _pending_changes.depth:
+            _pending_changes.changes = {}
+        raise
+    _pending_changes.depth -= 1
+    if not _pending_changes.depth:
+        changes, _pending_changes.changes = _pending_changes.changes, {}
+        for EventModel, (tree_ids, event_ids, touched) in changes.items():
+            done = EventModel._occurrences_changed(tree_ids, event_ids)
+            touched = touched - done
+            if touched:
+                EventModel.touch_occurrences(tree_ids=list(touched))
+
+class OccurrenceSummary(object):
+    """
+    What the occurrences in an event's listing add up to: the first and last
+    starts, the number of occurrences (and of forthcoming occurrences) with
+    each status, and the start times of the occurrences attached directly to
+    the event. This is all that season(), status(), is_finished(),
+    unavailable_status_message(), times_description() etc. need to know.
+
+    Forthcoming counts depend on when the summary was made, so a summary
+    expires when its next forthcoming occurrence starts, or when its last
+    occurrence ends.
+    """
+
+    def __init__(self, now, rows, start_times, last_end=None):
+        """
+        rows are (status, forthcoming, count, first start, last start) for
+        each group of occurrences.
+        """
+        self.counts = {}
+        self.forthcoming_counts = {}
+        self.start_times = set(start_times)
+        self.first_start = self.last_start = self.next_start = None
+        self.last_end = last_end
+
+        for status, forthcoming, count, first, last in rows:
+            self.counts[status] = self.counts.get(status, 0) + count
+            if forthcoming:
+                self.forthcoming_counts[status] = \
+                    self.forthcoming_counts.get(status, 0) + count
+                self.next_start = min(filter(None, [self.next_start, first]))
+            self.first_start = min(filter(None, [self.first_start, first]))
+            self.last_start = max(filter(None, [self.last_start, last]))
+
+        self.expires = self.next_start
+        if self.last_end is not None and self.last_end >= now:
+            self.expires = min(filter(None, [self.expires, self.last_end]))
+
+    def is_current(self, now):
+        return self.expires is None or now < self.expires
+
+    def timeout(self, now):
+        """
+        The number of seconds to cache this summary for.
+        """
+        timeout = settings.OCCURRENCE_SUMMARY_TIMEOUT
+        if self.expires is not None:
+            td = self.expires - now
+            timeout = min(timeout, td.days * 24 * 60 * 60 + td.seconds + 1)
+        return timeout
+
+    def _count(self, counts, statuses):
+        if statuses is None:
+            return sum(counts.values())
+        return sum(counts.get(status, 0) for status in statuses)
+
+    def count(self, statuses=None):
+        """
+        The number of occurrences with one of the given statuses (or all).
+        """
+        return self._count(self.counts, statuses)
+
+    def forthcoming_count(self, statuses=None):
+        return self._count(self.forthcoming_counts, statuses)
+
+    def is_finished(self):
+        if self.last_start is None:
+            return None
+        if self.last_end is None: # the last occurrence hadn't started
+            return False
+        return self.last_end < datetime.datetime.now()
+
+
 class EventModel(MPTTModel):
     __metaclass__ = EventModelBase
     
@@ -212,6 +407,11 @@ class EventModel(MPTTModel):
         verbose_name=_('parent'),
         help_text=_("Which event is this event derived from. Use the 'create a variation' on the parent event to inherit the parent's information."))
     # 'parent' is more flexible than 'template'.
+    # The listing index, maintained by rebuild_listing_index().
+    _has_occurrences = models.BooleanField(default=False, editable=False, db_index=True)
+    _listed_under = models.ForeignKey('self',
+        null=True, blank=True, editable=False, related_name='_listed_events',
+        on_delete=models.SET_NULL)
     title = models.CharField(_('title'), max_length=255)
     slug = models.SlugField(_("URL name"), unique=True, help_text=_("This is used in\
      the event's URL, and should be unique and unchanging."))
@@ -255,22 +455,193 @@ class EventModel(MPTTModel):
 
     def save(self, *args, **kwargs):
         """
-        When an event is saved, the changes to fields are cascaded to children,
-        and any endless generators are updated, so that a few more occurrences
-        are generated
+        When an event is saved, the changes to fields are cascaded to children.
+
+        (Endless generators are extended by the extend_generators management
+        command, not here.)
         """
         #this has to happen before super.save, so that we can tell what's
         #changed
         if not self.slug:
             self.slug = slugify(unicode(self))
 
-        self._cascade_changes_to_children()
-        r = super(EventModel, self).save(*args, **kwargs)
-
-        endless_generators = self.generators.filter(repeat_until__isnull=True)
-        [g.save() for g in endless_generators]
+        saved = []
+        if self.pk:
+            saved = list(type(self)._event_manager \
+                .filter(pk=self.pk).values_list('tree_id', 'parent'))
+
+        # my children are saved too, so this changes my tree once.
+        with batched_occurrence_changes():
+            self._cascade_changes_to_children()
+            r = super(EventModel, self).save(*args, **kwargs)
+
+            if not saved or saved[0] != (self.tree_id, self.parent_id):
+                # I'm new, or have moved in the tree, maybe under a listed
+                # event, or taking my occurrences away from another tree.
+                tree_ids = set([self.tree_id] + [t for t, p in saved])
+                type(self)._occurrences_changed(tree_ids=tree_ids)
+            else:
+                # the listing index is the same, but my fields may be in
+                # what is cached for my tree (eg iCal feeds).
+                type(self)._event_fields_changed(tree_ids=[self.tree_id])
 
         return r
+
+    def occurrences_changed(self):
+        """
+        Called whenever occurrences are added to, removed from, or changed
+        in my tree, to keep what is derived from them up to date (or at the
+        end of a batched_occurrence_changes() block).
+        """
+        type(self)._occurrences_changed(tree_ids=[self.tree_id])
+
+    @classmethod
+    def _occurrences_changed(cls, tree_ids=(), event_ids=()):
+        """
+        Does what occurrences_changed() does for the given trees, and the
+        trees of the given events (by pk), or, in a
+        batched_occurrence_changes() block, notes them for the end of it.
+        Returns the trees that were changed.
+        """
+        if _pending_changes.depth:
+            pending = cls._pending()
+            pending[0].update(tree_ids)
+            pending[1].update(event_ids)
+            return set()
+
+        tree_ids = set(tree_ids)
+        if event_ids:
+            tree_ids.update(cls._event_manager.filter(pk__in=list(event_ids)) \
+                .order_by().values_list('tree_id', flat=True))
+        if tree_ids:
+            cls.rebuild_listing_index(tree_ids=list(tree_ids))
+            cls.touch_occurrences(tree_ids=list(tree_ids))
+        return tree_ids
+
+    @classmethod
+    def _event_fields_changed(cls, tree_ids):
+        """
+        Changes the occurrences_version of the given trees, without
+        rebuilding their listing index, at the end of any
+        batched_occurrence_changes() block.
+        """
+        if _pending_changes.depth:
+            cls._pending()[2].update(tree_ids)
+        else:
+            cls.touch_occurrences(tree_ids=list(tree_ids))
+
+    @classmethod
+    def _pending(cls):
+        return _pending_changes.changes.setdefault(cls, (set(), set(), set()))
+
+    @classmethod
+    def _occurrences_version_key(cls, tree_id=None):
+        if tree_id is None:
+            tree_id = 'all'
+        return 'eventtools.occurrences_version.%s.%s' % (
+            cls._meta.db_table, tree_id)
+
+    @classmethod
+    def occurrences_version(cls, tree_id=None):
+        """
+        Returns a stamp that changes whenever the occurrences in the given tree
+        (or any tree) change, for use in the keys of cached things that are
+        derived from them. The stamp is a tuple of the times (as far as the
+        cache knows) of the last change to any tree, and to the given tree.
+        """
+        if tree_id is None:
+            return cls._occurrences_versions([])[None]
+        return cls._occurrences_versions([tree_id])[tree_id]
+
+    @classmethod
+    def _occurrences_versions(cls, tree_ids):
+        """
+        Returns {tree_id: occurrences_version(tree_id)} for the given trees,
+        and {None: occurrences_version()}, with one cache lookup.
+        """
+        all_key = cls._occurrences_version_key()
+        keys = dict((tree_id, cls._occurrences_version_key(tree_id))
+            for tree_id in tree_ids)
+        keys[None] = all_key
+        now = time.time()
+        stamps = cache.get_many(keys.values())
+        missing = [key for key in keys.values() if key not in stamps]
+        if missing:
+            for key in missing:
+                cache.add(key, now, OCCURRENCES_VERSION_TIMEOUT)
+            stamps.update(cache.get_many(missing))
+
+        all_stamp = stamps.get(all_key, now)
+        versions = dict((tree_id, (all_stamp, stamps.get(key, now)))
+            for tree_id, key in keys.items())
+        versions[None] = (all_stamp,)
+        return versions
+
+    @classmethod
+    def touch_occurrences(cls, tree_ids=None):
+        """
+        Changes the occurrences_version of the given trees (or of all trees), so
+        that anything cached for them is invalidated. Call this if you change
+        occurrences behind eventtools' back (eg with raw SQL).
+        """
+        keys = [cls._occurrences_version_key()] + \
+            [cls._occurrences_version_key(tree_id) for tree_id in tree_ids or []]
+        old_stamps = cache.get_many(keys)
+        # make sure the stamps change, however coarse the clock.
+        now = max([time.time()] + [stamp + 0.001 for stamp in old_stamps.values()])
+        cache.set_many(dict((key, now) for key in keys), OCCURRENCES_VERSION_TIMEOUT)
+
+    @classmethod
+    def rebuild_listing_index(cls, tree_ids=None):
+        """
+        Recomputes the listing index for the events in the given trees (or
+        all events). For each event, this stores whether the event has
+        occurrences attached directly, and the event it is listed under (see
+        listed_under()), so that listings don't have to walk the tree.
+
+        Only events whose values have changed are updated.
+        """
+        events = cls._event_manager.all()
+        occurrences = cls.OccurrenceModel()._default_manager.all()
+        if tree_ids is not None:
+            events = events.filter(tree_id__in=tree_ids)
+            occurrences = occurrences.filter(event__tree_id__in=tree_ids)
+
+        having_occurrences = set(
+            occurrences.order_by().values_list('event', flat=True).distinct()
+        )
+
+        listed_under = {}
+        updates = {}
+        # Ordered by tree and lft, so parents come before their children.
+        for pk, parent_id, has_occurrences, listed_under_id in events \
+            .values_list('pk', 'parent', '_has_occurrences', '_listed_under'):
+            new_has_occurrences = pk in having_occurrences
+            listed_under[pk] = listed_under.get(parent_id) or \
+                (pk if new_has_occurrences else None)
+            new_values = (new_has_occurrences, listed_under[pk])
+            if new_values != (has_occurrences, listed_under_id):
+                updates.setdefault(new_values, []).append(pk)
+
+        for (has_occurrences, listed_under_id), pks in updates.items():
+            cls._event_manager.filter(pk__in=pks).update(
+                _has_occurrences=has_occurrences,
+                _listed_under=listed_under_id,
+            )
+
+    def resync_generators(self):
+        """
+        Synchronises the occurrences of all my generators in one pass: the
+        candidate occurrences of every generator are diffed against my
+        existing occurrences once, rather than once per generator. This also
+        brings generators up to date whose occurrences used to clash with
+        another generator's.
+
+        Where generators would generate the same occurrence, the generator
+        that was created first gets it.
+        """
+        generators = self.generators.select_related('rule').order_by('pk')
+        self.GeneratorModel()._sync_generators(self, generators)
                 
     def reload(self):
         """
@@ -335,28 +706,154 @@ class EventModel(MPTTModel):
         except IndexError:
             return None
 
+    def occurrence_summary(self):
+        """
+        Returns the OccurrenceSummary of my listing. Summaries are cached until
+        occurrences in my tree change, or they expire, and I keep mine (as
+        attach_occurrence_summaries() does) until it expires, so that the
+        status methods share it. Reload me to see changes to my occurrences.
+
+        To get the summaries of a list of events at once, use
+        EventQuerySet.with_listing_summary() or attach_occurrence_summaries().
+        """
+        now = datetime.datetime.now()
+        summary = self.__dict__.get('_occurrence_summary')
+        if summary is None or not summary.is_current(now):
+            summary = type(self)._occurrence_summaries([self], now)[self.pk]
+            self._occurrence_summary = summary
+        return summary
+
+    @classmethod
+    def attach_occurrence_summaries(cls, events):
+        """
+        Gives each of the given events its occurrence_summary(), so that
+        rendering a list of events doesn't query or look up each one's listing.
+        """
+        events = list(events)
+        summaries = cls._occurrence_summaries(events, datetime.datetime.now())
+        for event in events:
+            event._occurrence_summary = summaries[event.pk]
+
+    @classmethod
+    def _occurrence_summaries(cls, events, now):
+        """
+        Returns {pk: OccurrenceSummary} for the given events, from the cache,
+        or summarised together if they're missing from it.
+        """
+        versions = cls._occurrences_versions(set(e.tree_id for e in events))
+        keys = dict((e.pk, 'eventtools.occurrence_summary.%s.%s.%s' % (
+            cls._meta.db_table, e.pk,
+            "-".join("%f" % stamp for stamp in versions[e.tree_id])
+        )) for e in events)
+
+        cached = cache.get_many(keys.values())
+        summaries = {}
+        missing = []
+        for event in events:
+            summary = cached.get(keys[event.pk])
+            if summary is not None and summary.is_current(now):
+                summaries[event.pk] = summary
+            else:
+                missing.append(event)
+
+        if missing:
+            for pk, summary in cls._summarise_listings(missing, now).items():
+                summaries[pk] = summary
+                cache.set(keys[pk], summary, summary.timeout(now))
+        return summaries
+
+    @classmethod
+    def _summarise_listings(cls, events, now):
+        """
+        Returns {pk: OccurrenceSummary} for the listings of the given events,
+        with one grouped query over all of them (and another if any of them
+        have started their last occurrence, to find when it ends).
+        """
+        OccurrenceModel = cls.OccurrenceModel()
+        opts = OccurrenceModel._meta
+        qn = connection.ops.quote_name
+        column = lambda name: "%s.%s" % (
+            qn(opts.db_table), qn(opts.get_field(name).column))
+
+        select = SortedDict([
+            ('forthcoming', "CASE WHEN %s >= %%s THEN 1 ELSE 0 END" % column('start')),
+        ])
+        select_params = [connection.ops.value_to_db_datetime(now)]
+        start_time_sql = time_sql(column('start'))
+        if start_time_sql is not None:
+            select['start_time'] = start_time_sql
+
+        listings = reduce(or_, [
+            Q(event__tree_id=e.tree_id, event__lft__gte=e.lft, event__lft__lte=e.rght)
+            for e in events
+        ])
+        groups_by_tree = {}
+        for group in OccurrenceModel.objects.filter(listings).order_by() \
+            .extra(select=select, select_params=select_params) \
+            .values('event', 'event__tree_id', 'event__lft', 'status', *select.keys()) \
+            .annotate(n=Count('start'), first=Min('start'), last=Max('start')):
+            groups_by_tree.setdefault(group['event__tree_id'], []).append(group)
+
+        if start_time_sql is None:
+            direct_start_times = {}
+            for event_id, start in OccurrenceModel.objects \
+                .filter(event__in=[e.pk for e in events]) \
+                .values_list('event', 'start'):
+                direct_start_times.setdefault(event_id, set()).add(start.time())
+
+        summaries = {}
+        closing = {}
+        for event in events:
+            rows = []
+            start_times = set()
+            last = None # (start, event_id), as occurrences are ordered
+            for group in groups_by_tree.get(event.tree_id, []):
+                if not event.lft <= group['event__lft'] <= event.rght:
+                    continue
+                rows.append((group['status'], group['forthcoming'], group['n'],
+                    group['first'], group['last']))
+                if group['event'] == event.pk and start_time_sql is not None:
+                    start_times.add(time_from_db(group['start_time']))
+                if last is None or (group['last'], group['event']) > last:
+                    last = (group['last'], group['event'])
+            if start_time_sql is None:
+                start_times = direct_start_times.get(event.pk, set())
+
+            summaries[event.pk] = OccurrenceSummary(now, rows, start_times)
+            if last is not None and last[0] < now:
+                closing[event.pk] = (rows, start_times, last)
+
+        if closing:
+            closing_occurrences = reduce(or_, [
+                Q(start=start, event=event_id)
+                for rows, start_times, (start, event_id) in closing.values()
+            ])
+            ends = dict(((o.start, o.event_id), o.end()) for o in
+                OccurrenceModel.objects.filter(closing_occurrences))
+            for pk, (rows, start_times, last) in closing.items():
+                summaries[pk] = OccurrenceSummary(now, rows, start_times,
+                    last_end=ends.get(last))
+        return summaries
+
     def get_absolute_url(self):
         return reverse('events:event', kwargs={'event_slug': self.slug })
         
     def is_finished(self):
         """ the event has finished if the closing occurrence has finished. """
-        closing_occurrence = self.closing_occurrence()
-        if closing_occurrence:
-            return closing_occurrence.is_finished()
+        return self.occurrence_summary().is_finished()
 
     def listed_under(self):
         """
         This event is listed under the highest ancestor that has Occurrences directly attached.
         """
         try:
-            return self.get_ancestors().having_occurrences().order_by('level')[0]
-        except (IndexError, AttributeError):
-            if self.occurrences.count():
-                return self
-        return None
+            return type(self)._event_manager.filter(_listed_events=self)[0]
+        except IndexError:
+            return None
 
     def is_listed(self):
-        return self.listed_under() == self
+        return type(self)._event_manager \
+            .filter(pk=self.pk, _listed_under=self).exists()
     is_listed.boolean = True
 
     def season(self):
@@ -366,12 +863,11 @@ class EventModel(MPTTModel):
         if self.season_description:
             return self.season_description
         
-        o = self.opening_occurrence()
-        c = self.closing_occurrence()
+        summary = self.occurrence_summary()
         
-        if o and c:
-            first = o.start.date()
-            last = c.start.date()
+        if summary.first_start and summary.last_start:
+            first = summary.first_start.date()
+            last = summary.last_start.date()
             return pprint_date_span(first, last)
             
         return None
@@ -381,7 +877,7 @@ class EventModel(MPTTModel):
 
     def occurrence_statuses(self):
         #returns a set of statuses of my occurrences
-        return set(self.occurrences_in_listing().values_list('status', flat=True).distinct())
+        return set(self.occurrence_summary().counts.keys())
 
     def status(self):
         #returns a status if all occurrences have the same status.
@@ -393,32 +889,36 @@ class EventModel(MPTTModel):
 
     def is_cancelled(self):
         """Return True if all occurrences are cancelled"""
-        cancelled = self.cancelled_occurrences().count()
-        return cancelled > 0 and self.occurrences_in_listing().count() == cancelled
+        summary = self.occurrence_summary()
+        cancelled = summary.count([settings.OCCURRENCE_STATUS_CANCELLED[0]])
+        return cancelled > 0 and summary.count() == cancelled
 
     def forthcoming_is_cancelled(self):
         """Return True if all forthcoming occurrences are cancelled"""
-        forthcoming = self.occurrences_in_listing().forthcoming().count()
-        cancelled_forthcoming = self.cancelled_occurrences().forthcoming().count()
+        summary = self.occurrence_summary()
+        forthcoming = summary.forthcoming_count()
+        cancelled_forthcoming = summary.forthcoming_count([settings.OCCURRENCE_STATUS_CANCELLED[0]])
         return cancelled_forthcoming > 0 and forthcoming == cancelled_forthcoming
 
     def is_fully_booked(self):
         """
         Return True if no occurrences are available and at least one is fully booked. (a mix of cancelled and fully booked is allowed)
         """
-        return self.available_occurrences().count() == 0 and self.fully_booked_occurrences().count() > 0
+        summary = self.occurrence_summary()
+        return summary.count(AVAILABLE_STATUSES) == 0 and summary.count([settings.OCCURRENCE_STATUS_FULLY_BOOKED[0]]) > 0
 
     def forthcoming_is_fully_booked(self):
         """
         Return True if no forthcoming occurrences are available and at least one is fully booked. (a mix of cancelled and fully booked is allowed)
         """
-        return self.available_occurrences().forthcoming().count() == 0 and self.fully_booked_occurrences().forthcoming().count() > 0
+        summary = self.occurrence_summary()
+        return summary.forthcoming_count(AVAILABLE_STATUSES) == 0 and summary.forthcoming_count([settings.OCCURRENCE_STATUS_FULLY_BOOKED[0]]) > 0
 
     def is_available(self):
         """
         Return True if any sessions are available (ie not cancelled or fully booked)
         """
-        return self.available_occurrences().count() > 0
+        return self.occurrence_summary().count(AVAILABLE_STATUSES) > 0
 
     def unavailable_status_message(self):
         if self.is_finished():
@@ -457,9 +957,7 @@ class EventModel(MPTTModel):
         if not formatting: # use default formatting
             formatting = '%I.%M%p'
 
-        starting_times = list(set([
-            occurrence.start.time() for occurrence in self.occurrences.all()
-        ]))
+        starting_times = list(self.occurrence_summary().start_times)
 
         if len(starting_times) == 1:
             # `lower` converts Django's 'PM' into 'pm' and `lstrip` removes any leading '0'
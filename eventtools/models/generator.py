@@ -1,20 +1,33 @@
 # -*- coding: utf-8 -*-
 
 
-from django.db import models, transaction
+from django.db import connection, models, transaction
+from django.db.models import Max, Min, Q
 from django.db.models.base import ModelBase
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.core import exceptions
 
 from dateutil import rrule
+from eventtools.models.event import batched_occurrence_changes
 from eventtools.models.xtimespan import XTimespanModel
 
 from eventtools.conf import settings
 from eventtools.utils.pprint_timespan import (
     pprint_datetime_span, pprint_date_span)
+from eventtools.utils.expansion import expand_datetimes
+from eventtools.utils.sqldates import shift_datetime_sql
 
+import heapq
 from datetime import date, time, datetime, timedelta
 
+def _batches(items, size):
+    """
+    Yields successive lists of at most `size` items.
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
 class GeneratorModel(XTimespanModel):
     """
     Stores information about repeating Occurrences, and generates them,
@@ -43,6 +56,8 @@ class GeneratorModel(XTimespanModel):
             "occurrences will be created."
         )
     )
+    # The latest start that has been considered for generation.
+    generated_until = models.DateTimeField(null=True, blank=True, editable=False)
 
     class Meta:
         abstract = True
@@ -56,6 +71,10 @@ class GeneratorModel(XTimespanModel):
     @classmethod
     def EventModel(cls):
         return cls._meta.get_field('event').rel.to
+
+    @classmethod
+    def OccurrenceModel(cls):
+        return cls.occurrences.related.model
         
     def clean(self, ExceptionClass=exceptions.ValidationError):
         super(GeneratorModel, self).clean()
@@ -83,10 +102,16 @@ class GeneratorModel(XTimespanModel):
                 the generator.
 
         Finally, we also update other generators, because they might have had
-        clashing occurrences which no longer clash.
+        clashing occurrences which no longer clash. This is done for all the
+        event's generators together, in one pass (see
+        EventModel.resync_generators). Pass cascade=False to only synchronise
+        this generator, or sync=False to skip step 2 altogether (eg when
+        several generators are being saved, and the event will be resynced
+        afterwards).
         """
         
         cascade = kwargs.pop('cascade', True)
+        sync = kwargs.pop('sync', True)
         
         if not getattr(self, 'is_clean', False):
             # if we're saving directly, the ModelForm clean isn't called, so
@@ -97,27 +122,180 @@ class GeneratorModel(XTimespanModel):
         if self.pk:
             self._update_existing_occurrences() # need to do this before save, so we can detect changes
         r = super(GeneratorModel, self).save(*args, **kwargs)
-        self._sync_occurrences() #need to do this after save, so we have a pk to hang new occurrences from.
-    
-        # finally, we should also update other generators, because they might 
-        # have had clashing occurrences
-        if cascade:
-            for generator in self.event.generators.exclude(pk=self.pk):
-                generator.save(cascade=False)
+
+        #need to do this after save, so we have a pk to hang new occurrences from.
+        if sync:
+            if cascade:
+                # we should also update other generators, because they might
+                # have had clashing occurrences
+                self.event.resync_generators()
+            else:
+                self._sync_occurrences()
         
         return r
         
-    def _generate_dates(self):
+    def _drop_dead_date(self, horizon=None):
+        """
+        Endless generators generate up to the horizon date, which defaults to
+        GENERATOR_MATERIALISE_WINDOW (or DEFAULT_GENERATOR_LIMIT) from today.
+        """
+        if horizon is None:
+            horizon = date.today() + (settings.GENERATOR_MATERIALISE_WINDOW or
+                settings.DEFAULT_GENERATOR_LIMIT)
+        return datetime.combine(self.repeat_until or horizon, time.max)
+
+    def _generate_dates(self, horizon=None, after=None):
+        """
+        Returns the candidate starts of this generator (after the given
+        datetime, if any) in order. Simple rules are expanded in one go (see
+        eventtools.utils.expansion); others are stepped through with dateutil.
+        """
+        drop_dead_date = self._drop_dead_date(horizon)
+
+        if not self.rule.complex_rule:
+            starts = expand_datetimes(self.rule.frequency,
+                self.rule.get_params(), self.start, drop_dead_date, after)
+            if starts is not None:
+                return starts
+        return self._iter_rrule_dates(drop_dead_date, after)
+
+    @transaction.commit_on_success()
+    def extend(self, horizon=None):
+        """
+        Generates my occurrences from where generation last stopped (or just
+        after the last one I generated), up to the horizon (see
+        _drop_dead_date), leaving the existing ones alone. Returns the number
+        of occurrences created.
+
+        This is what keeps endless generators going: run the extend_generators
+        management command regularly (eg daily, from cron). Only the new
+        stretch of the rule is expanded, so this costs the same for old and
+        new generators.
+        """
+        OccurrenceModel = type(self).OccurrenceModel()
+        drop_dead_date = self._drop_dead_date(horizon)
+        after = self.generated_until
+        if after is None:
+            after = self.occurrences.aggregate(last=Max('start'))['last']
+        elif after >= drop_dead_date:
+            return 0
+
+        starts = list(self._generate_dates(horizon, after))
+        self._set_generated_until(drop_dead_date)
+        if not starts:
+            return 0
+
+        event = self.event
+        occupied_starts = set(event.occurrences_in_listing() \
+            .filter(start__gte=starts[0], start__lte=starts[-1]) \
+            .values_list('start', flat=True))
+        event_exclusions = set(event.exclusions \
+            .filter(start__gte=starts[0], start__lte=starts[-1]) \
+            .values_list('start', flat=True))
+
+        new_occurrences = [
+            OccurrenceModel(event=event, generated_by=self,
+                start=start, _duration=self._duration,
+                _end=start + self.duration)
+            for start in starts
+            if start not in occupied_starts and start not in event_exclusions
+        ]
+        for batch in _batches(new_occurrences, settings.OCCURRENCE_BATCH_SIZE):
+            OccurrenceModel._default_manager.bulk_create(batch)
+
+        if new_occurrences:
+            event.occurrences_changed()
+        return len(new_occurrences)
+
+    def virtual_occurrences(self, fr, to):
+        """
+        Returns the occurrences I would generate between the datetimes fr and
+        to (inclusive), beyond where my stored occurrences stop (see
+        GENERATOR_MATERIALISE_WINDOW), as unsaved occurrences. Their
+        is_virtual() is True, and materialise() stores them.
+
+        Exclusions apply, and stored occurrences at the same start (eg
+        materialised ones) take their place.
+        """
+        return type(self)._virtual_occurrences([self], fr, to)
+
+    @classmethod
+    def _virtual_occurrences(cls, generators, fr, to):
+        """
+        Returns the virtual occurrences of the given endless generators,
+        between fr (or where they stop storing occurrences, if None) and to,
+        in start order. Whatever is stored in the range is
+        loaded in one query for all the generators, and likewise exclusions.
+        """
+        OccurrenceModel = cls.OccurrenceModel()
+        ExclusionModel = cls.EventModel().ExclusionModel()
+        generators = sorted([
+            g for g in generators
+            if g.repeat_until is None and g.generated_until is not None
+            and g.generated_until < to
+        ], key=lambda g: g.pk)
+        if not generators:
+            return []
+
+        # virtual occurrences start after the stored ones stop.
+        afters = dict((g.pk, g.generated_until) for g in generators)
+        if fr is not None:
+            just_before_fr = fr - timedelta(microseconds=1)
+            afters = dict((pk, max(after, just_before_fr))
+                for pk, after in afters.items())
+        starts = dict((g.pk, [
+            start for start in g._generate_dates(to.date(), afters[g.pk])
+            if start <= to
+        ]) for g in generators)
+        lowest = min(afters.values())
+        event_ids = set(g.event_id for g in generators)
+
+        generated_starts = set()
+        occupied_starts = set()
+        for event_id, generated_by_id, start in OccurrenceModel._default_manager \
+            .filter(start__gt=lowest, start__lte=to) \
+            .filter(Q(generated_by__in=[g.pk for g in generators]) | Q(event__in=event_ids)) \
+            .values_list('event', 'generated_by', 'start'):
+            generated_starts.add((generated_by_id, start))
+            occupied_starts.add((event_id, start))
+        occupied_starts.update(ExclusionModel._default_manager \
+            .filter(event__in=event_ids, start__gt=lowest, start__lte=to) \
+            .values_list('event', 'start'))
+
+        runs = []
+        for generator in generators:
+            run = []
+            for start in starts[generator.pk]:
+                if (generator.pk, start) in generated_starts or \
+                    (generator.event_id, start) in occupied_starts:
+                    continue
+                occupied_starts.add((generator.event_id, start))
+                occurrence = OccurrenceModel(event=generator.event,
+                    generated_by=generator, start=start,
+                    _duration=generator._duration,
+                    _end=start + generator.duration)
+                occurrence._virtual = True
+                run.append(((start, generator.event_id), occurrence))
+            runs.append(run)
+        # each generator's run is in start order already.
+        return [occurrence for key, occurrence in heapq.merge(*runs)]
+
+    def _iter_rrule_dates(self, drop_dead_date, after=None):
         rule = self.rule.get_rrule(dtstart=self.start)
         date_iter = iter(rule)
-        drop_dead_date = datetime.combine(self.repeat_until or date.today() \
-            + settings.DEFAULT_GENERATOR_LIMIT, time.max)
                 
         while True:
             d = date_iter.next()
             if d > drop_dead_date:
                 break
-            yield d
+            if after is None or d > after:
+                yield d
+
+    def _set_generated_until(self, generated_until):
+        if generated_until != self.generated_until:
+            self.generated_until = generated_until
+            type(self)._default_manager.filter(pk=self.pk) \
+                .update(generated_until=generated_until)
     
     @transaction.commit_on_success()
     def _update_existing_occurrences(self):
@@ -169,97 +347,233 @@ class GeneratorModel(XTimespanModel):
         start_shift = self.start - saved_self.start
         duration_changed = self._duration != saved_self._duration
 
-        if start_shift or duration_changed:
-            # Update occurrences in opposite direction to the adjustment of the
-            # 'start' field, to avoid updating an occurrence to clash with an
-            # existing one's (event_id, start) DB uniqueness constraint (#606)
-            if start_shift.total_seconds() >= 0:
-                start_order_by = '-start'  # Moving to future, start from latest
-            else:
-                start_order_by = 'start'  # Moving to past, start from earliest
+        with batched_occurrence_changes():
+            if start_shift:
+                if not self._timeshift_occurrences_in_bulk(start_shift):
+                    self._timeshift_occurrences_one_by_one(start_shift)
+            elif duration_changed:
+                self.occurrences.update(_duration=self._duration)
+                self._set_occurrence_ends()
 
-            for o in self.occurrences.order_by(start_order_by):
-                o.start += start_shift
-                o._duration = self._duration
-                o.save()
+            if start_shift or duration_changed:
+                self.event.occurrences_changed()
+
+    def _timeshift_occurrences_in_bulk(self, start_shift):
+        """
+        Moves all my occurrences by start_shift, and gives them my duration,
+        with a constant number of UPDATE statements. Returns False (having done
+        nothing) if the database backend isn't supported.
+
+        Shifting all the occurrences in one UPDATE could make an occurrence
+        clash part-way through the statement with another one's old start,
+        breaking the (event_id, start) DB uniqueness constraint (#606). So
+        this is done in two phases: first all my occurrences are moved by a
+        temporary offset to beyond the latest occurrence in the table, then
+        they are moved back, to where they belong.
+        """
+        OccurrenceModel = type(self).OccurrenceModel()
+        opts = OccurrenceModel._meta
+        qn = connection.ops.quote_name
+
+        first = self.occurrences.aggregate(first=Min('start'))['first']
+        if first is None:
+            return True
+        last = OccurrenceModel._default_manager \
+            .aggregate(last=Max('start'))['last']
+        offset = last - first + abs(start_shift) + timedelta(days=1)
+
+        start_column = qn(opts.get_field('start').column)
+        phase1 = shift_datetime_sql(start_column, offset.total_seconds())
+        phase2 = shift_datetime_sql(start_column,
+            start_shift.total_seconds() - offset.total_seconds())
+        if phase1 is None or phase2 is None:
+            return False
+
+        table = qn(opts.db_table)
+        generator_column = qn(opts.get_field('generated_by').column)
+        duration_column = qn(opts.get_field('_duration').column)
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE %s SET %s = %s WHERE %s = %%s" % (
+                table, start_column, phase1, generator_column),
+            [self.pk])
+        cursor.execute(
+            "UPDATE %s SET %s = %s, %s = %%s WHERE %s = %%s" % (
+                table, start_column, phase2, duration_column,
+                generator_column),
+            [self._duration, self.pk])
+        transaction.set_dirty()
+        self._set_occurrence_ends()
+        return True
+
+    def _set_occurrence_ends(self):
+        """
+        Sets the stored end of my occurrences, after their start or duration
+        has been changed with an UPDATE, to their start plus my duration.
+        """
+        OccurrenceModel = type(self).OccurrenceModel()
+        opts = OccurrenceModel._meta
+        qn = connection.ops.quote_name
+        start_column = qn(opts.get_field('start').column)
+        end = shift_datetime_sql(start_column, self.duration.total_seconds())
+        if end is None:
+            duration = self.duration
+            for pk, start in self.occurrences.values_list('pk', 'start'):
+                OccurrenceModel._default_manager.filter(pk=pk) \
+                    .update(_end=start + duration)
+            return
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE %s SET %s = %s WHERE %s = %%s" % (
+                qn(opts.db_table), qn(opts.get_field('_end').column), end,
+                qn(opts.get_field('generated_by').column)),
+            [self.pk])
+        transaction.set_dirty()
+
+    def _timeshift_occurrences_one_by_one(self, start_shift):
+        # Update occurrences in opposite direction to the adjustment of the
+        # 'start' field, to avoid updating an occurrence to clash with an
+        # existing one's (event_id, start) DB uniqueness constraint (#606)
+        if start_shift.total_seconds() >= 0:
+            start_order_by = '-start'  # Moving to future, start from latest
+        else:
+            start_order_by = 'start'  # Moving to past, start from earliest
+
+        for o in self.occurrences.order_by(start_order_by):
+            o.start += start_shift
+            o._duration = self._duration
+            o.save()
 
     
-    @transaction.commit_on_success()
     def _sync_occurrences(self):
+        """
+        Pass 2), for this generator only.
+        """
+        type(self)._sync_generators(self.event, [self])
+
+    @classmethod
+    @transaction.commit_on_success()
+    def _sync_generators(cls, event, generators):
     
         """
         Pass 2)
 
-        Generate a list of candidate occurrences.
+        Generate a list of candidate occurrences for each of the given
+        generators of the event.
         * For candidate occurrences that exist, do nothing.
         * For candidate occurrences that do not exist, add them.
         * For existing occurrences that are not candidates, delete them, or unhook them from the
           generator if they are protected by a Foreign Key.
             
         In detail:
-        Get a list, A, of already-generated occurrences.
-        
-        Generate candidate Occurrences.
-        For each candidate Occurrence:
-            if it exists for the event:
-                if I created it, unhook, and remove from the list A.
-                else do nothing
+        Load the starts of the occurrences already in the event's listing
+        (regardless of generator), annotated with whether they are exclusions,
+        and the exclusions of the event, in one query each. The diff is then
+        worked out in memory.
+
+        The occurrences generated by one of the generators, which that
+        generator would no longer generate (or which are now exclusions) are
+        'orphan' occurrences. These are deleted (or unhooked from the
+        generator) in batches. Their starts become free for other generators.
+
+        Then, generator by generator, for each candidate start:
+            if an occurrence exists at that start, do nothing
             if it is an exclusion, do nothing
-            otherwise create it.
-            
-        The items remaining in list A are 'orphan' occurrences, that were
-        previously generated, but would no longer be. These are unhooked from
-        the generator.
+            otherwise it is created (all in one bulk insert).
         """
-        
-        all_occurrences = self.event.occurrences_in_listing().all() #regardless of generator
-        existing_but_not_regenerated = set(self.occurrences.all()) #generated by me only
-
-        for start in self._generate_dates():
-            # if the proposed occurrence exists, then don't make a new one.
-            # However, if it belongs to me: 
-            #       and if it is marked as an exclusion:
-            #           do nothing (it will later get deleted/unhooked)
-            #       else:
-            #           remove it from the set of existing_but_not_regenerated
-            #           occurrences so it stays hooked up
+        OccurrenceModel = cls.OccurrenceModel()
+        generators = list(generators)
+        drop_dead_dates = dict((g.pk, g._drop_dead_date()) for g in generators)
+        candidates = dict((g.pk, list(g._generate_dates())) for g in generators)
+
+        event_exclusions = set(event.exclusions.values_list('start', flat=True))
+
+        existing = list(event.occurrences_in_listing().annotate_is_exclusion() \
+            .values_list('pk', 'start', 'generated_by', '_is_exclusion')
+        ) #regardless of generator
+
+        candidate_sets = dict((pk, set(starts)) for pk, starts in candidates.items())
+        # Stored occurrences beyond the drop dead date (eg materialised
+        # virtual ones) are kept if the rule still generates them.
+        stored_until = {}
+        for pk, start, generated_by_id, is_exclusion in existing:
+            if generated_by_id in candidate_sets and \
+                start > drop_dead_dates[generated_by_id]:
+                stored_until[generated_by_id] = max(
+                    start, stored_until.get(generated_by_id, start))
+        for generator in generators:
+            if generator.pk in stored_until:
+                candidate_sets[generator.pk].update(generator._generate_dates(
+                    stored_until[generator.pk].date(),
+                    drop_dead_dates[generator.pk]))
+        orphans = [
+            pk for pk, start, generated_by_id, is_exclusion in existing
+            if generated_by_id in candidate_sets and (
+                start not in candidate_sets[generated_by_id] or is_exclusion
+            )
+        ]
+        deleted = set(orphans) - cls._delete_occurrences(orphans)
+        occupied_starts = set(
+            start for pk, start, generated_by_id, is_exclusion in existing
+            if pk not in deleted
+        )
+
+        new_occurrences = []
+        for generator in generators:
+            for start in candidates[generator.pk]:
+                # if the proposed occurrence exists, or is an exclusion, then
+                # don't make a new one.
+                if start in occupied_starts or start in event_exclusions:
+                    continue
+                #OK, we're good to create the occurrence.
+                occupied_starts.add(start)
+                new_occurrences.append(OccurrenceModel(
+                    event=event, generated_by=generator,
+                    start=start, _duration=generator._duration,
+                    _end=start + generator.duration,
+                ))
+
+        for batch in _batches(new_occurrences, settings.OCCURRENCE_BATCH_SIZE):
+            OccurrenceModel._default_manager.bulk_create(batch)
+        for generator in generators:
+            generator._set_generated_until(drop_dead_dates[generator.pk])
 
+        if orphans or new_occurrences:
+            event.occurrences_changed()
+
+    @classmethod
+    def _delete_occurrences(cls, pks):
+        """
+        Delete the given occurrences in batches. If we can't delete a batch,
+        due to protection set by FKs to some of its occurrences, then delete
+        them one at a time, so the protected ones are unhooked instead.
+
+        Returns the set of pks that were unhooked rather than deleted.
+        """
+        OccurrenceModel = cls.OccurrenceModel()
+        unhooked = set()
+        for batch in _batches(pks, settings.OCCURRENCE_BATCH_SIZE):
+            qs = OccurrenceModel._default_manager.filter(pk__in=batch)
             try:
-                o = all_occurrences.filter(start=start)[0]
-                if o.generated_by == self:
-                    if not o.is_exclusion():
-                        existing_but_not_regenerated.discard(o)
-                continue
-            except IndexError:
-                # no occurrence exists yet.
-                pass
-
-            # if the proposed occurrence is an exclusion, don't save it.
-            if self.event.exclusions.filter(
-                event=self.event, start=start
-            ).count():
-                continue            
-
-            #OK, we're good to create the occurrence.
-            o = self.occurrences.create(event=self.event, start=start, _duration=self._duration)
-#            print "created %s" % o
-            #implied generated_by = self
-    
-        # Finally, delete any unaccounted_for occurrences. If we can't delete, due to protection set by FKs to it, then
-        # unhook it instead.
-        for o in existing_but_not_regenerated:
-#            print "deleting %s" % o
-            o.delete()
+                qs.delete()
+            except models.ProtectedError:
+                with batched_occurrence_changes():
+                    for o in qs:
+                        o.delete()
+                unhooked.update(qs.values_list('pk', flat=True))
+        return unhooked
 
     def delete(self, *args, **kwargs):
         """
         If I am deleted, then cascade to my Occurrences, UNLESS there is is something FKed to them that is protecting them,
         in which case the FK is set to NULL.
         """
-        for o in self.occurrences.all():
-            o.delete()
+        self._delete_occurrences(self.occurrences.values_list('pk', flat=True))
 
         super(GeneratorModel,self).delete(*args, **kwargs)
+        self.event.occurrences_changed()
 
     def robot_description(self):
         r = "%s, repeating %s" % (
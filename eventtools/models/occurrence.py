@@ -1,6 +1,6 @@
 from vobject.icalendar import utc
 
-from django.db import models
+from django.db import models, connection
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils.safestring import mark_safe
@@ -8,16 +8,23 @@ from django.core.urlresolvers import reverse
 from django.db.models import signals
 from django.db.models.base import ModelBase
 from django.template.defaultfilters import urlencode
+from django.utils.http import urlquote
 from django.utils.dateformat import format
 from django.utils.translation import ugettext as _
 from eventtools.models.xtimespan import XTimespanModel, XTimespanQSFN, XTimespanQuerySet, XTimespanManager
 from eventtools.conf import settings
 
-from eventtools.utils import datetimeify, dayify
+from eventtools.utils import datetimeify, dayify, dateranges, ics, timezones
+from eventtools.utils.sqldates import date_sql, date_from_db
 from eventtools.utils.managertype import ManagerType
 
 import datetime
-from dateutil.tz import gettz
+import heapq
+
+# The order in which stored occurrences are merged with virtual ones, which
+# are keyed by (start, event_id). Ordering by 'event' would order by the
+# events' own ordering, ie their positions in the tree, which isn't pk order.
+START_ORDERING = ('start', 'event__id')
 
 
 
@@ -46,6 +53,152 @@ class OccurrenceQSFN(XTimespanQSFN):
         event_ids = self.values_list('event_id', flat=True).distinct()
         return self.model.EventModel()._event_manager.filter(id__in=event_ids)
 
+    def annotate_is_exclusion(self):
+        """
+        Annotates each occurrence with whether its event has an exclusion at
+        its start (in one subquery, rather than a query per occurrence), which
+        is_exclusion() then uses. The annotation is named '_is_exclusion', so
+        it can also be used in values() and values_list().
+        """
+        ExclusionModel = self.model.EventModel().ExclusionModel()
+        qn = connection.ops.quote_name
+        occurrence_table = qn(self.model._meta.db_table)
+        exclusion_table = qn(ExclusionModel._meta.db_table)
+        sql = "EXISTS (SELECT 1 FROM %s WHERE %s.%s = %s.%s AND %s.%s = %s.%s)" % (
+            exclusion_table,
+            exclusion_table, qn(ExclusionModel._meta.get_field('event').column),
+            occurrence_table, qn(self.model._meta.get_field('event').column),
+            exclusion_table, qn(ExclusionModel._meta.get_field('start').column),
+            occurrence_table, qn(self.model._meta.get_field('start').column),
+        )
+        return self.extra(select={'_is_exclusion': sql})
+
+    # Record the range of starts, for with_virtual().
+    def starts_before(self, date):
+        qs = super(OccurrenceQSFN, self).starts_before(date)
+        end = datetimeify(date, clamp="max")
+        if qs._starts_to is None or end < qs._starts_to:
+            qs._starts_to = end
+        return qs
+
+    def starts_after(self, date):
+        qs = super(OccurrenceQSFN, self).starts_after(date)
+        start = datetimeify(date, clamp="min")
+        if qs._starts_from is None or start > qs._starts_from:
+            qs._starts_from = start
+        return qs
+
+    before = starts_before
+    after = starts_after
+
+    def with_virtual(self):
+        """
+        Returns these occurrences merged, in start order, with the virtual
+        occurrences of endless generators (see
+        GeneratorModel.virtual_occurrences) in the range of starts given by
+        starts_after(), starts_before(), starts_between(), starts_on() or
+        forthcoming(). If no end is given, the range ends
+        DEFAULT_GENERATOR_LIMIT from today.
+
+        The generators are those of the events the occurrences were got from
+        with EventQuerySet.occurrences(), or else all generators. Other
+        filters aren't applied to the virtual occurrences, and only iterating
+        includes them (count() and values() don't) - to count or paginate
+        them, use between_with_virtual().
+
+        The merged occurrences are always in ascending order of start, then
+        of event pk (see START_ORDERING), not tree order: any other ordering,
+        eg order_by('-start'), is replaced when they are iterated (unless
+        they have been sliced). Reverse the list yourself if you need them
+        latest first.
+        """
+        qs = self._clone()
+        qs._with_virtual = True
+        return qs
+
+    def between_with_virtual(self, fr, to, generator_index=None):
+        """
+        Returns an OccurrenceRange of these occurrences that start between fr
+        and to, merged with the virtual occurrences in that range, which can
+        be counted and sliced as well as iterated (e.g. by Paginator). As
+        with with_virtual(), they are in ascending order of start, whatever
+        order_by() says.
+        """
+        from eventtools.models.occurrencerange import OccurrenceRange
+        return OccurrenceRange(self.all(), fr, to, generator_index)
+
+    def chunks(self, size=None):
+        """
+        Yields lists of these occurrences in start order (then event pk, see
+        START_ORDERING), `size` (default OCCURRENCE_BATCH_SIZE) at a time,
+        each fetched with a query that starts after the last occurrence of the
+        previous one, so that memory use doesn't grow with the number of
+        occurrences. Virtual occurrences aren't included.
+        """
+        size = size or settings.OCCURRENCE_BATCH_SIZE
+        qs = self.order_by(*START_ORDERING)
+        qs._with_virtual = False
+        chunk = qs
+        while True:
+            occurrences = list(chunk[:size])
+            if occurrences:
+                yield occurrences
+            if len(occurrences) < size:
+                return
+            last = occurrences[-1]
+            chunk = qs.filter(
+                models.Q(start__gt=last.start) |
+                models.Q(start=last.start, event__gt=last.event_id))
+
+    def in_chunks(self, size=None):
+        """
+        Iterates over these occurrences, fetching them a chunk at a time (see
+        chunks()).
+        """
+        for occurrences in self.chunks(size):
+            for occurrence in occurrences:
+                yield occurrence
+
+    def histogram(self, start, end, bucket='day', by_status=False):
+        """
+        Counts these occurrences that start between the dates start and end,
+        in buckets of a 'day', 'week' or 'month' (see
+        eventtools.utils.dateranges), with one grouped query.
+
+        Returns {first date of bucket: count} for the buckets with
+        occurrences, or, if by_status is True, {first date of bucket:
+        {status: count}}. Day histograms can be passed to the nav_calendar
+        and nav_calendars tags instead of occurrences.
+        """
+        bucket_start = {
+            'day': lambda d: d,
+            'week': lambda d: dateranges.dates_for_week_of(d)[0],
+            'month': lambda d: dateranges.dates_for_month_of(d)[0],
+        }[bucket]
+
+        qs = self.starts_between(start, end).order_by()
+        qn = connection.ops.quote_name
+        start_date_sql = date_sql("%s.%s" % (qn(self.model._meta.db_table),
+            qn(self.model._meta.get_field('start').column)))
+        if start_date_sql is not None:
+            rows = qs.extra(select={'start_date': start_date_sql}) \
+                .values_list('start_date', 'status') \
+                .annotate(n=models.Count('pk'))
+            rows = [(date_from_db(d), status, n) for d, status, n in rows]
+        else:
+            rows = [(s.date(), status, 1) for s, status in
+                qs.values_list('start', 'status')]
+
+        result = {}
+        for day, status, n in rows:
+            key = bucket_start(day)
+            if by_status:
+                counts = result.setdefault(key, {})
+                counts[status] = counts.get(status, 0) + n
+            else:
+                result[key] = result.get(key, 0) + n
+        return result
+
     def available(self):
         return self.filter(status__in=("", None))
 
@@ -59,7 +212,50 @@ class OccurrenceQSFN(XTimespanQSFN):
         return self.filter(status=settings.OCCURRENCE_STATUS_CANCELLED[0])
 
 class OccurrenceQuerySet(XTimespanQuerySet, OccurrenceQSFN):
-    pass #all the goodness is inherited from OccurrenceQuerySetFN
+    #all the goodness is inherited from OccurrenceQuerySetFN, except for
+    #merging in virtual occurrences.
+    _with_virtual = False
+    _virtual_events = None
+    _starts_from = None
+    _starts_to = None
+
+    def _clone(self, *args, **kwargs):
+        c = super(OccurrenceQuerySet, self)._clone(*args, **kwargs)
+        c._with_virtual = self._with_virtual
+        c._virtual_events = self._virtual_events
+        c._starts_from = self._starts_from
+        c._starts_to = self._starts_to
+        return c
+
+    def iterator(self):
+        if not self._with_virtual:
+            return super(OccurrenceQuerySet, self).iterator()
+        qs = self
+        if qs.query.can_filter():
+            # merging needs ascending starts, whatever order was asked for
+            qs = qs.order_by(*START_ORDERING)
+        return self._merge_virtual(super(OccurrenceQuerySet, qs).iterator())
+
+    def _virtual_generators(self):
+        GeneratorModel = self.model.EventModel().GeneratorModel()
+        generators = GeneratorModel._default_manager \
+            .filter(repeat_until__isnull=True, generated_until__isnull=False) \
+            .select_related('rule', 'event')
+        if self._virtual_events is not None:
+            generators = generators.filter(event__in=self._virtual_events)
+        return generators
+
+    def _merge_virtual(self, stored):
+        GeneratorModel = self.model.EventModel().GeneratorModel()
+        generators = self._virtual_generators()
+        to = self._starts_to or datetimeify(
+            datetime.date.today() + settings.DEFAULT_GENERATOR_LIMIT, clamp="max")
+        virtual = GeneratorModel._virtual_occurrences(generators,
+            self._starts_from, to)
+
+        keyed = lambda occurrences: (((o.start, o.event_id), o) for o in occurrences)
+        for key, occurrence in heapq.merge(keyed(stored), keyed(virtual)):
+            yield occurrence
 
 class OccurrenceManager(XTimespanManager):
     __metaclass__ = ManagerType(OccurrenceQSFN, supertype=XTimespanManager.__metaclass__,)
@@ -67,6 +263,74 @@ class OccurrenceManager(XTimespanManager):
     def get_query_set(self): 
         return OccurrenceQuerySet(self.model)
 
+def _has_default_url(occurrence):
+    return type(occurrence).get_absolute_url.im_func is \
+        OccurrenceModel.get_absolute_url.im_func
+
+class ICalFeed(object):
+    """
+    What is the same for all the occurrences in an iCal feed (see
+    OccurrenceModel.as_ics), worked out once: the domain, the time of the
+    feed, the form of occurrences' URLs, and the attributes of each event.
+    """
+    # placeholders, to reverse the occurrence URL once
+    _SLUG = 'eventtools-event-slug'
+    _PK = '2147483647'
+
+    def __init__(self, request, dtstamp=None):
+        self.host = request.get_host()
+        self.domain = "".join(('http', ('', 's')[request.is_secure()], '://', self.host))
+        self.dtstamp = dtstamp or datetime.datetime.utcnow()
+        self._event_attrs = {}
+        self._memoised_attrs = {}
+        self._url_format = None
+
+    def memoised_attrs(self, model):
+        """
+        Returns the attributes of occurrences of the model to resolve once
+        per event (see OccurrenceModel.ical_event_attrs).
+        """
+        try:
+            return self._memoised_attrs[model]
+        except KeyError:
+            attrs = self._memoised_attrs[model] = model._ical_event_attrs()
+            return attrs
+
+    def event_attr(self, occurrence, attr):
+        key = (occurrence.event_id, attr)
+        try:
+            return self._event_attrs[key]
+        except KeyError:
+            value = self._event_attrs[key] = occurrence._resolve_attr(attr)
+            return value
+
+    def convert_times(self, occurrences):
+        """
+        Converts the times of the (naive, not all-day) occurrences to UTC
+        for as_ics(), all at once (see eventtools.utils.timezones).
+        """
+        if not getattr(settings, 'TIME_ZONE', None):
+            return
+        occurrences = [o for o in occurrences
+            if o.start.tzinfo is None and not o.all_day()]
+        tz = timezones.get_zone(settings.TIME_ZONE)
+        starts = timezones.to_utc_many([o.start for o in occurrences], tz)
+        ends = timezones.to_utc_many([o.end() for o in occurrences], tz)
+        for o, start, end in zip(occurrences, starts, ends):
+            o._ical_utc_times = start.replace(tzinfo=utc), end.replace(tzinfo=utc)
+
+    def occurrence_url(self, occurrence):
+        """
+        Returns occurrence.get_absolute_url(), without reversing it again.
+        """
+        if self._url_format is None:
+            url = reverse('events:occurrence', kwargs={
+                'event_slug': self._SLUG, 'occurrence_pk': self._PK})
+            self._url_format = url.replace('%', '%%') \
+                .replace(self._PK, '%(pk)s').replace(self._SLUG, '%(slug)s')
+        return self._url_format % {
+            'slug': urlquote(occurrence.event.slug), 'pk': occurrence.pk}
+
 class OccurrenceModel(XTimespanModel):
     """
     An abstract model for an event occurrence.
@@ -99,18 +363,66 @@ class OccurrenceModel(XTimespanModel):
     def EventModel(cls):
         return cls._meta.get_field('event').rel.to
 
+    def is_virtual(self):
+        """
+        True for occurrences that are computed from a generator's rule, rather
+        than stored (see GeneratorModel.virtual_occurrences).
+        """
+        return getattr(self, '_virtual', False)
+
+    def materialise(self):
+        """
+        Stores a virtual occurrence, eg so that something can FK to it, or to
+        change its status. Returns the stored occurrence, which is self
+        unless it had already been stored.
+        """
+        if not self.is_virtual():
+            return self
+        try:
+            return type(self)._default_manager \
+                .get(event=self.event_id, start=self.start)
+        except type(self).DoesNotExist:
+            self.save()
+            self._virtual = False
+            return self
+
     def is_exclusion(self):
-        qs = self.event.exclusions.filter(start=self.start)
-        if qs.count():
-            return True
-        return False
+        if hasattr(self, '_is_exclusion'): # see annotate_is_exclusion()
+            return bool(self._is_exclusion)
+        return self.event.exclusions.filter(start=self.start).exists()
         
+    def __init__(self, *args, **kwargs):
+        super(OccurrenceModel, self).__init__(*args, **kwargs)
+        # the event I was loaded with, to tell in save() if I've been moved.
+        # (event_id isn't read if it is deferred, which would be a query.)
+        self._saved_event_id = self.__dict__.get('event_id') if self.pk else None
+
+    def save(self, *args, **kwargs):
+        """
+        Tell my event (and the event I've been moved from, if any) that its
+        occurrences have changed.
+        """
+        moved_from = None
+        if self.pk and self._saved_event_id not in (None, self.event_id):
+            moved_from = self._saved_event_id
+
+        r = super(OccurrenceModel, self).save(*args, **kwargs)
+        self._saved_event_id = self.event_id
+
+        event_ids = [self.event_id]
+        if moved_from is not None:
+            event_ids.append(moved_from)
+        self.EventModel()._occurrences_changed(event_ids=event_ids)
+        return r
+
     def delete(self, *args, **kwargs):
         try:
             r = super(OccurrenceModel, self).delete(*args, **kwargs)
         except models.ProtectedError: #can't delete as there is an FK to me. Make one-off..
             self.generated_by = None
             self.save()
+        else:
+            self.EventModel()._occurrences_changed(event_ids=[self.event_id])
 
     def is_cancelled(self):
         return self.status == settings.OCCURRENCE_STATUS_CANCELLED[0]
@@ -147,6 +459,22 @@ class OccurrenceModel(XTimespanModel):
                  v = v()
          return v
 
+    # The iCalendar attributes (see as_icalendar) that only depend on the
+    # event, which feeds resolve once per event. Add to this if you define
+    # eg venue_description, latitude and longitude from the event.
+    # ical_summary and ical_description are included unless overridden (see
+    # _ical_event_attrs).
+    ical_event_attrs = ()
+
+    @classmethod
+    def _ical_event_attrs(cls):
+        attrs = set(cls.ical_event_attrs)
+        for attr in ('ical_summary', 'ical_description'):
+            if getattr(cls, attr).im_func is \
+                getattr(OccurrenceModel, attr).im_func:
+                attrs.add(attr)
+        return attrs
+
     def ical_summary(self):
          return unicode(self.event)
 
@@ -180,27 +508,9 @@ class OccurrenceModel(XTimespanModel):
          """
          vevent = ical.add('vevent')
 
-         start = self.start
-         # Calculate the end date using the start + duration
-         end = self.start + self.duration
-
-         if self.all_day():
-             vevent.add('dtstart').value = start.date()
-             vevent.add('dtend').value = end.date()
-         else:
-             # Add the timezone specified in the project settings to the event start
-             # and end datetimes, if they don't have a timezone already
-             if not start.tzinfo and not end.tzinfo \
-                     and getattr(settings, 'TIME_ZONE', None):
-                 tz = gettz(settings.TIME_ZONE)
-                 start = start.replace(tzinfo=tz)
-                 end = end.replace(tzinfo=tz)
-                 # Since Google Calendar (and probably others) can't handle timezone
-                 # declarations inside ICS files, convert to UTC before adding.
-                 start = start.astimezone(utc)
-                 end = end.astimezone(utc)
-             vevent.add('dtstart').value = start
-             vevent.add('dtend').value = end
+         start, end = self._ical_times()
+         vevent.add('dtstart').value = start
+         vevent.add('dtend').value = end
 
          cancelled = self._resolve_attr(cancelled_attr)
          if cancelled:
@@ -231,6 +541,94 @@ class OccurrenceModel(XTimespanModel):
 
          return ical
 
+    def _ical_times(self):
+         """
+         Returns the start and end to put in an iCalendar: dates for all-day
+         occurrences, or else datetimes. Naive datetimes are taken to be in
+         settings.TIME_ZONE, and converted to UTC, since Google Calendar (and
+         probably others) can't handle timezone declarations inside ICS files.
+         """
+         if hasattr(self, '_ical_utc_times'): # see ICalFeed.convert_times()
+             return self._ical_utc_times
+
+         start = self.start
+         # Calculate the end date using the start + duration
+         end = self.start + self.duration
+
+         if self.all_day():
+             return start.date(), end.date()
+
+         # Add the timezone specified in the project settings to the event start
+         # and end datetimes, if they don't have a timezone already
+         if not start.tzinfo and not end.tzinfo \
+                 and getattr(settings, 'TIME_ZONE', None):
+             tz = timezones.get_zone(settings.TIME_ZONE)
+             start = start.replace(tzinfo=tz).astimezone(utc)
+             end = end.replace(tzinfo=tz).astimezone(utc)
+         return start, end
+
+    def ics_uid(self, host):
+         """
+         A UID that stays the same from feed to feed, so that calendar apps
+         update the occurrence rather than adding it again.
+         """
+         return u"occurrence-%s-%s@%s" % (
+             self.event_id, ics.format_datetime(self.start)[:-1], host)
+
+    def as_ics(self,
+         request,
+         feed=None,
+         summary_attr='ical_summary',
+         description_attr='ical_description',
+         url_attr='get_absolute_url',
+         location_attr='venue_description',
+         latitude_attr='latitude',
+         longitude_attr='longitude',
+         cancelled_attr='is_cancelled',
+    ):
+         """
+         Returns the occurrence as an iCalendar VEVENT (a UTF-8 encoded
+         string), with the same properties as as_icalendar(), but written
+         directly (see eventtools.utils.ics), which is much faster.
+
+         When writing many occurrences, pass the same ICalFeed to each.
+         Attributes named in ical_event_attrs (and ical_summary and
+         ical_description, unless they are overridden) are then resolved once
+         per event.
+         """
+         if feed is None:
+             feed = ICalFeed(request)
+         start, end = self._ical_times()
+
+         memoised_attrs = feed.memoised_attrs(type(self))
+         def resolve(attr):
+             if attr in memoised_attrs:
+                 return feed.event_attr(self, attr)
+             return self._resolve_attr(attr)
+
+         if url_attr == 'get_absolute_url' and _has_default_url(self):
+             url = feed.occurrence_url(self)
+         else:
+             url = self._resolve_attr(url_attr)
+         if url:
+             url = "%s%s" % (feed.domain, url)
+
+         lat = resolve(latitude_attr)
+         lon = resolve(longitude_attr)
+
+         return ics.vevent(
+             uid=self.ics_uid(feed.host),
+             dtstamp=feed.dtstamp,
+             dtstart=start,
+             dtend=end,
+             summary=resolve(summary_attr),
+             description=resolve(description_attr),
+             url=url,
+             location=resolve(location_attr),
+             geo="%s;%s" % (lon, lat) if lat and lon else None,
+             cancelled=self._resolve_attr(cancelled_attr),
+         )
+
     def ics_url(self):
          """
          Needs to be fully-qualified (for sending to calendar apps). Your app needs to define
@@ -0,0 +1,158 @@
+"""
+Calendar queries across stored and virtual occurrences.
+
+Stored occurrences are in the database, and virtual ones are computed from the
+rules of endless generators beyond where they stop storing occurrences (see
+GeneratorModel.virtual_occurrences). An OccurrenceRange answers "all the
+occurrences in [fr, to]" across both, in start order, and can be paginated:
+
+    from eventtools.utils.viewutils import paginate
+    pageinfo = paginate(request, occurrence_qs.between_with_virtual(fr, to))
+"""
+import heapq
+from bisect import bisect_left
+from operator import itemgetter
+
+from eventtools.models.occurrence import START_ORDERING
+from eventtools.utils import datetimeify
+
+
+def _keyed(occurrences):
+    # stored occurrences are ordered to match (see START_ORDERING)
+    return (((o.start, o.event_id), o) for o in occurrences)
+
+
+class GeneratorIndex(object):
+    """
+    An interval index of generators by the span of starts in which they have
+    virtual occurrences, so that only the generators that can have virtual
+    occurrences in a given range are expanded.
+
+    Only endless generators have virtual occurrences, from their
+    generated_until onwards, so the spans are kept sorted by their beginning,
+    and a range is looked up by bisection.
+    """
+
+    def __init__(self, generators):
+        spans = sorted([
+            (g.generated_until, g) for g in generators
+            if g.repeat_until is None and g.generated_until is not None
+        ], key=itemgetter(0))
+        self._begins = [begin for begin, g in spans]
+        self._generators = [g for begin, g in spans]
+
+    def __len__(self):
+        return len(self._generators)
+
+    def overlapping(self, fr, to):
+        """
+        Returns the generators that can have virtual occurrences between fr
+        and to.
+        """
+        return [
+            g for g in self._generators[:bisect_left(self._begins, to)]
+            if g.start <= to
+        ]
+
+
+class OccurrenceRange(object):
+    """
+    The stored occurrences of an OccurrenceQuerySet that start between fr and
+    to (inclusive), merged in start order with the virtual occurrences of the
+    same events' endless generators (see OccurrenceQuerySet.with_virtual).
+
+    Occurrences at the same start are in order of event pk.
+
+    It can be iterated, counted and sliced, which is what Paginator needs. The
+    virtual occurrences in the range are computed once, for the generators
+    that overlap it. The stored ones are counted and sliced in the database:
+    to find where a slice starts, a binary search over the virtual
+    occurrences looks up a few stored ones by position.
+
+    To query several ranges of the same events, pass the same GeneratorIndex
+    to each.
+    """
+
+    def __init__(self, occurrences, fr, to, generator_index=None):
+        self.fr = datetimeify(fr, clamp="min")
+        self.to = datetimeify(to, clamp="max")
+        self.stored = occurrences.starts_between(self.fr, self.to) \
+            .order_by(*START_ORDERING)
+        self.stored._with_virtual = False
+        self.occurrences = occurrences
+        self._generator_index = generator_index
+        self._virtual = None
+        self._stored_count = None
+
+    def generator_index(self):
+        if self._generator_index is None:
+            self._generator_index = GeneratorIndex(
+                self.occurrences._virtual_generators())
+        return self._generator_index
+
+    @property
+    def virtual(self):
+        """
+        The virtual occurrences in the range, in start order.
+        """
+        if self._virtual is None:
+            GeneratorModel = self.stored.model.EventModel().GeneratorModel()
+            self._virtual = GeneratorModel._virtual_occurrences(
+                self.generator_index().overlapping(self.fr, self.to),
+                self.fr, self.to)
+        return self._virtual
+
+    def count(self):
+        if self._stored_count is None:
+            self._stored_count = self.stored.count()
+        return self._stored_count + len(self.virtual)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        for key, occurrence in heapq.merge(
+            _keyed(self.stored.iterator()), _keyed(self.virtual)):
+            yield occurrence
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(self.count())
+            if step != 1:
+                return list(self)[k]
+            return self._slice(start, stop)
+
+        if k < 0:
+            k += self.count()
+        result = self._slice(k, k + 1)
+        if not result:
+            raise IndexError("OccurrenceRange index out of range")
+        return result[0]
+
+    def _stored_key(self, position):
+        return tuple(self.stored.values_list('start', 'event')[position])
+
+    def _slice(self, start, stop):
+        if stop <= start:
+            return []
+        virtual = self.virtual
+        stored_count = self.count() - len(virtual)
+
+        # Find how many of the first `start` occurrences are virtual: the
+        # fewest v such that virtual[v] doesn't come before the stored
+        # occurrence that would otherwise be taken.
+        lo = max(0, start - stored_count)
+        hi = min(start, len(virtual))
+        while lo < hi:
+            v = (lo + hi) // 2
+            if (virtual[v].start, virtual[v].event_id) < \
+                self._stored_key(start - v - 1):
+                lo = v + 1
+            else:
+                hi = v
+        v = lo
+
+        size = stop - start
+        stored = list(self.stored[start - v:start - v + size])
+        merged = heapq.merge(_keyed(stored), _keyed(virtual[v:v + size]))
+        return [occurrence for key, occurrence in merged][:size]
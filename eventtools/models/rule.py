@@ -4,6 +4,9 @@ from django.utils.translation import ugettext, ugettext_lazy as _
 from dateutil import rrule
 from dateutil.relativedelta import weekdays
 
+from eventtools.conf import settings
+from eventtools.utils.lrucache import LRUCache
+
 freqs = (
     ("YEARLY", _("Yearly")),
     ("MONTHLY", _("Monthly")),
@@ -11,6 +14,16 @@ freqs = (
     ("DAILY", _("Daily")),
 )
 
+FREQUENCIES = {
+    "YEARLY": rrule.YEARLY,
+    "MONTHLY": rrule.MONTHLY,
+    "WEEKLY": rrule.WEEKLY,
+    "DAILY": rrule.DAILY,
+}
+
+# Compiled rrules, keyed by (rule pk, rule content hash, dtstart)
+_rrule_cache = LRUCache(settings.RRULE_CACHE_SIZE)
+
 class Rule(models.Model):
     """
     This defines a rule by which an occurrence will repeat. Parameters
@@ -89,7 +102,37 @@ class Rule(models.Model):
         """Human readable string for Rule"""
         return self.name or unicode(self.frequency).lower()
     
+    def save(self, *args, **kwargs):
+        r = super(Rule, self).save(*args, **kwargs)
+        self._discard_cached_rrules()
+        return r
+
+    def delete(self, *args, **kwargs):
+        self._discard_cached_rrules()
+        super(Rule, self).delete(*args, **kwargs)
+
+    def _discard_cached_rrules(self):
+        pk = self.pk
+        _rrule_cache.discard_if(lambda key: key[0] == pk)
+
+    def content_hash(self):
+        return hash((self.frequency, self.params, self.complex_rule))
+
     def get_rrule(self, dtstart):
+        """
+        Returns the rrule for this rule, starting from dtstart.
+
+        Compiled rrules are cached for the process (see RRULE_CACHE_SIZE), so
+        the result is shared, and must not be modified.
+        """
+        key = (self.pk, self.content_hash(), dtstart)
+        r = _rrule_cache.get(key)
+        if r is None:
+            r = self._compile_rrule(dtstart)
+            _rrule_cache.set(key, r)
+        return r
+
+    def _compile_rrule(self, dtstart):
         if self.complex_rule:
             d = dtstart.date()
             weekday = weekdays[d.weekday()]
@@ -113,8 +156,7 @@ class Rule(models.Model):
             except ValueError: # eg. unsupported property 
                 pass
         params = self.get_params()
-        frequency = 'rrule.%s' % self.frequency
-        simple_rule = rrule.rrule(eval(frequency), dtstart=dtstart, **params)
+        simple_rule = rrule.rrule(FREQUENCIES[self.frequency], dtstart=dtstart, **params)
         rs = rrule.rruleset()
         rs.rrule(simple_rule)
         return rs
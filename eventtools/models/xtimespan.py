@@ -36,6 +36,29 @@ class XTimespanQSFN(object):
     between = starts_between
     on = starts_on
 
+    def ends_before(self, date):
+        end = datetimeify(date, clamp="max")
+        return self.filter(_end__lte=end)
+    def ends_after(self, date):
+        start = datetimeify(date, clamp="min")
+        return self.filter(_end__gte=start)
+
+    def overlapping(self, d1, d2):
+        """
+        returns the occurrences that are on at any time in a given
+        date/datetime range (ie that start before it ends, and end after it
+        starts), using the indexed start and _end columns.
+        """
+        return self.starts_before(d2).ends_after(d1)
+
+    def on_at(self, dt):
+        """
+        returns the occurrences that are on at a given datetime. Note that
+        'all day' occurrences have no duration, so are only on at midnight -
+        use overlapping() with the day to include them.
+        """
+        return self.overlapping(dt, dt)
+
     #misc queries (note they assume starts_)
     def forthcoming(self):
         return self.starts_after(datetime.datetime.now())
@@ -56,6 +79,9 @@ class XTimespanManager(models.Manager):
 class XTimespanModel(models.Model):
     start = models.DateTimeField(db_index=True, verbose_name=_('start'))
     _duration = models.PositiveIntegerField(_("duration (mins)"), blank=True, null=True, help_text=_("to create 'all day' events, set start time to 00:00 and leave duration blank"))
+    # end(), stored for overlapping() queries. It is set on save; code that
+    # changes start or _duration without saving must also set it.
+    _end = models.DateTimeField(db_index=True, null=True, editable=False)
 
     objects = XTimespanManager()
 
@@ -63,6 +89,10 @@ class XTimespanModel(models.Model):
         abstract = True
         ordering = ('start', )
 
+    def save(self, *args, **kwargs):
+        self._end = self.end()
+        return super(XTimespanModel, self).save(*args, **kwargs)
+
     def get_duration(self):
         """
         _duration is a value in minutes. The duration property returns a 
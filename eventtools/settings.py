@@ -18,13 +18,44 @@ OCCURRENCES_PER_PAGE = 20
 ICAL_CALNAME = getattr(settings, 'SITE_NAME', 'Events list')
 ICAL_CALDESC = "Events listing" #e.g. "Events listing from mysite.com"
 
+# iCal feeds are written this many occurrences (fetched in one query) at a time.
+ICAL_CHUNK_SIZE = 5000
+
+# iCal feeds of up to ICAL_CACHE_MAX_SIZE bytes are cached for this many
+# seconds, or until their occurrences change (see response_as_ical).
+ICAL_CACHE_TIMEOUT = 60 * 60 * 24
+ICAL_CACHE_MAX_SIZE = 1024 * 1024
+
 from dateutil.relativedelta import relativedelta
 DEFAULT_GENERATOR_LIMIT = relativedelta(years=1) #months=6, etc
 
+# If set (eg to relativedelta(months=3)), endless generators only store their
+# occurrences this far ahead, rather than DEFAULT_GENERATOR_LIMIT ahead. Later
+# occurrences are 'virtual' (see GeneratorModel.virtual_occurrences).
+GENERATOR_MATERIALISE_WINDOW = None
+
+# The number of compiled repetition rules (per rule and start) to keep in memory.
+RRULE_CACHE_SIZE = 1000
+
+# The number of months' calendar grids (see templatetags/calendar.py) to keep
+# in memory.
+CALENDAR_MONTH_CACHE_SIZE = 240
+
+# The HTML of cached_nav_calendars is cached for at most this many seconds
+# (or until the event's occurrences change).
+CALENDAR_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Generated occurrences are inserted and deleted this many at a time.
+OCCURRENCE_BATCH_SIZE = 100
+
+# Summaries of events' occurrences (see EventModel.occurrence_summary) are
+# cached for at most this many seconds.
+OCCURRENCE_SUMMARY_TIMEOUT = 60 * 60
+
 OCCURRENCE_STATUS_CANCELLED =  ('cancelled', 'Cancelled')
 OCCURRENCE_STATUS_FULLY_BOOKED = ('fully booked', 'Fully Booked')
 
 OCCURRENCE_STATUS_CHOICES = [
    OCCURRENCE_STATUS_CANCELLED,
    OCCURRENCE_STATUS_FULLY_BOOKED,
-]
\ No newline at end of file
+]
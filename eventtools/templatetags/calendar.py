@@ -5,17 +5,41 @@ if not pycal:
     pycal = imp.load_module('calendar',*imp.find_module('calendar'))
 
 import datetime
+import hashlib
+from copy import copy
 from dateutil.relativedelta import *
 from django import template
-from django.template.context import RequestContext
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.template.context import Context, RequestContext
 from django.template import TemplateSyntaxError
 from django.core.urlresolvers import reverse
 
 from eventtools.conf import settings as eventtools_settings
 from eventtools.models import EventModel, OccurrenceModel
+from eventtools.utils.lrucache import LRUCache
 
 register = template.Library()
 
+def occurrence_days(occurrence_qs):
+    """
+    Returns a sorted list of the distinct dates on which the occurrences
+    start, fetched with one query if occurrence_qs is a queryset (rather
+    than loading every occurrence). occurrence_qs can also be a day
+    histogram (see OccurrenceQuerySet.histogram).
+    """
+    if occurrence_qs is None:
+        return []
+    if isinstance(occurrence_qs, dict): # see OccurrenceQuerySet.histogram()
+        return sorted(occurrence_qs)
+    if hasattr(occurrence_qs, 'dates') and occurrence_qs.query.can_filter():
+        return [
+            d.date() if isinstance(d, datetime.datetime) else d
+            for d in occurrence_qs.dates('start', 'day')
+        ]
+    return sorted(set(o.start.date() for o in occurrence_qs))
+
 def DATE_HREF_FACTORY(test_dates=True, dates=[]):
     """
     If test_dates is True, then URLs will only be returned if the day is in the
@@ -23,6 +47,7 @@ def DATE_HREF_FACTORY(test_dates=True, dates=[]):
     
     If test_dates is False, URLs are always returned.
     """
+    dates = frozenset(dates)
     def f(day):
         """
         Given a day, return a URL to navigate to.
@@ -36,7 +61,20 @@ def DATE_HREF_FACTORY(test_dates=True, dates=[]):
         return None
     return f
 
+def DATE_COUNT_FACTORY(histogram):
+    """
+    Returns the number of occurrences on a day, given a day histogram (see
+    OccurrenceQuerySet.histogram), which may be split by status.
+    """
+    def f(day):
+        count = histogram.get(day)
+        if isinstance(count, dict):
+            return sum(count.values())
+        return count
+    return f
+
 def DATE_CLASS_HIGHLIGHT_FACTORY(dates, selected_day):
+    dates = frozenset(dates)
     def f(day):
         r = set()
         if day == selected_day:
@@ -51,22 +89,59 @@ class DecoratedDate(object):
     A wrapper for date that has some css classes and a link, to use in rendering
     that date in a calendar.
     """
-    def __init__(self, date, href=None, classes=[], data=""):
+    __slots__ = ('date', 'href', 'classes', 'data', 'count')
+
+    def __init__(self, date, href=None, classes=[], data="", count=None):
         self.date = date
         self.href = href
         self.classes = classes
         self.data = data
+        self.count = count
     
     def __unicode__(self):
         if self.href:
             return "%s (%s)" % (self.date, self.href)
         return unicode(self.date)
                 
+# The parts of a month's calendar that are the same on every page, memoised
+# by (year, month, first day of the week).
+_month_cache = LRUCache(eventtools_settings.CALENDAR_MONTH_CACHE_SIZE)
+
+def month_skeleton(year, month):
+    """
+    Returns the weeks of a month as full weeks (tuples of seven days). Each
+    day is a tuple of its date, its ISO form, and its classes (the day of the
+    week, and 'last_month' or 'next_month' for leading and trailing days).
+    """
+    first_day_of_week = eventtools_settings.FIRST_DAY_OF_WEEK
+    key = (year, month, first_day_of_week)
+    weeks = _month_cache.get(key)
+    if weeks is None:
+        cal = pycal.Calendar(first_day_of_week)
+        weeks = []
+        for week in cal.monthdatescalendar(year, month):
+            days = []
+            for wday in week:
+                #day of the week class
+                classes = [wday.strftime('%A').lower()]
+                if wday.month != month:
+                    if (wday.year, wday.month) < (year, month):
+                        classes.append('last_month')
+                    else:
+                        classes.append('next_month')
+                #ISO data
+                days.append((wday, wday.isoformat(), tuple(classes)))
+            weeks.append(tuple(days))
+        weeks = tuple(weeks)
+        _month_cache.set(key, weeks)
+    return weeks
+
 def calendar(
         context, day=None,
         date_class_fn=None,
         date_href_fn=None,
         month_href_fn=None,
+        date_count_fn=None,
     ):
     """
     Creates an html calendar displaying one month, where each day has a link and
@@ -83,6 +158,8 @@ def calendar(
     month_href_fn:  a function that returns the url for a date, given a date
                     (which will be the first day of the next and previous
                     months)
+    date_count_fn:  a function that returns the number of occurrences on a
+                    date (given as the 'data-count' attribute), given a date
                     
 
     Automatic attributes:
@@ -107,6 +184,9 @@ def calendar(
 
     if month_href_fn is None:
         month_href_fn = lambda x: None
+
+    if date_count_fn is None:
+        date_count_fn = lambda x: None
     
     today = datetime.date.today()
 
@@ -121,32 +201,19 @@ def calendar(
     if isinstance(day, OccurrenceModel):
         day = day.start.date()
 
-    cal = pycal.Calendar(eventtools_settings.FIRST_DAY_OF_WEEK)
-    # cal is a list of the weeks in the month of the year as full weeks. 
-    # Weeks are lists of seven dates
-    weeks = cal.monthdatescalendar(day.year, day.month)
-    
-    # Transform into decorated dates
+    # Decorate the month's dates with the classes and links for this page.
     decorated_weeks = []
-    for week in weeks:
+    for week in month_skeleton(day.year, day.month):
         decorated_week = []
-        for wday in week:
+        for wday, data, static_classes in week:
             classes = set(date_class_fn(wday))
+            classes.update(static_classes)
             if wday == today:
                 classes.add('today')
-            if wday.month != day.month:
-                if wday < day:
-                    classes.add('last_month')
-                if wday > day:
-                    classes.add('next_month')
-            #day of the week class
-            classes.add(wday.strftime('%A').lower())
-            #ISO class
-            data = wday.isoformat()
-            
             decorated_week.append(
                 DecoratedDate(
                     date=wday, href=date_href_fn(wday), classes=classes, data=data,
+                    count=date_count_fn(wday),
                 )
             )
         decorated_weeks.append(decorated_week)
@@ -173,6 +240,11 @@ def calendar(
     return context
 
 
+def _date_count_fn(occurrence_qs):
+    if isinstance(occurrence_qs, dict):
+        return DATE_COUNT_FACTORY(occurrence_qs)
+    return None
+
 def nav_calendar(
         context, date=None, occurrence_qs=[],
         date_href_fn=None,
@@ -182,28 +254,30 @@ def nav_calendar(
     """
     Renders a nav calendar for a date, and an optional occurrence_qs.
     Dates in the occurrence_qs are given the class 'highlight'.
+
+    occurrence_qs can be a day histogram (see OccurrenceQuerySet.histogram)
+    instead, in which case dates are also given their number of occurrences.
     """
     
     #TODO: allow dates, not just occurrence_qs
-    if occurrence_qs:
-        occurrence_days = [o.start.date() for o in occurrence_qs]
-    else:
-        occurrence_days = []
+    days = occurrence_days(occurrence_qs)
+    date_count_fn = _date_count_fn(occurrence_qs)
     
     if date_href_fn is None:
-        date_href_fn = DATE_HREF_FACTORY(dates=occurrence_days)
+        date_href_fn = DATE_HREF_FACTORY(dates=days)
 
     if month_href_fn is None:
         month_href_fn = DATE_HREF_FACTORY(test_dates = False)
         
     if date_class_fn is None:
-        date_class_fn = DATE_CLASS_HIGHLIGHT_FACTORY(dates=occurrence_days, selected_day = date)
+        date_class_fn = DATE_CLASS_HIGHLIGHT_FACTORY(dates=days, selected_day = date)
 
     return calendar(
         context, day=date, 
         date_href_fn=date_href_fn,
         date_class_fn=date_class_fn,
         month_href_fn=month_href_fn,
+        date_count_fn=date_count_fn,
     )
 
 def nav_calendars(
@@ -214,21 +288,24 @@ def nav_calendars(
     """
     Renders several calendars, so as to encompass all dates in occurrence_qs.
     These will be folded up into a usable widget with javascript.
+
+    As with nav_calendar, occurrence_qs can be a day histogram.
     """
     
     #TODO: allow dates, not just occurrence_qs
-    if date_class_fn is None and occurrence_qs:
-        occurrence_days = [o.start.date() for o in occurrence_qs]
+    days = occurrence_days(occurrence_qs)
+    date_count_fn = _date_count_fn(occurrence_qs)
+    if date_class_fn is None and days:
         if selected_occurrence:
-            date_class_fn = DATE_CLASS_HIGHLIGHT_FACTORY(occurrence_days, selected_occurrence.start.date())
+            date_class_fn = DATE_CLASS_HIGHLIGHT_FACTORY(days, selected_occurrence.start.date())
         else:
-            date_class_fn = DATE_CLASS_HIGHLIGHT_FACTORY(occurrence_days, None)
+            date_class_fn = DATE_CLASS_HIGHLIGHT_FACTORY(days, None)
 
 
     calendars = []
-    if occurrence_qs.count() > 0:
-        first_date = occurrence_qs[0].start.date()
-        last_date = occurrence_qs.reverse()[0].start.date()
+    if days:
+        first_date = days[0]
+        last_date = days[-1]
     else:
         first_date = last_date = datetime.date.today()
     first_month = datetime.date(first_date.year, first_date.month, 1)
@@ -240,6 +317,7 @@ def nav_calendars(
                 {}, day=month, 
                 date_href_fn=date_href_fn,
                 date_class_fn=date_class_fn,
+                date_count_fn=date_count_fn,
             )
         )
         month += relativedelta(months=+1)
@@ -250,6 +328,39 @@ def nav_calendars(
     })
     return context
 
+def cached_nav_calendars(context, event, selected_occurrence=None):
+    """
+    Renders nav_calendars for the occurrences in an event's listing, and
+    caches the HTML until they change (see EventModel.occurrences_version),
+    so that repeat views of the event's page don't query the occurrences or
+    build the calendars again.
+
+    The calendars are rendered with (a copy of) the page's context, as the
+    nav_calendars tag does. As the HTML is cached for every page, overridden
+    calendar templates should only use what is the same on every page, such
+    as STATIC_URL.
+    """
+    key = 'eventtools.nav_calendars.%s' % hashlib.md5(repr((
+        event.pk,
+        getattr(selected_occurrence, 'pk', None),
+        event.occurrences_version(event.tree_id),
+        datetime.date.today(), # for the 'today' class
+        eventtools_settings.FIRST_DAY_OF_WEEK,
+    ))).hexdigest()
+    html = cache.get(key)
+    if html is None:
+        calendars = nav_calendars(copy(context),
+            event.occurrences_in_listing(), selected_occurrence)
+        if isinstance(calendars, Context):
+            html = render_to_string("eventtools/calendar/calendars.html", {},
+                context_instance=calendars)
+        else:
+            html = render_to_string("eventtools/calendar/calendars.html",
+                calendars)
+        cache.set(key, html, eventtools_settings.CALENDAR_CACHE_TIMEOUT)
+    return mark_safe(html)
+
 register.inclusion_tag("eventtools/calendar/calendar.html", takes_context=True)(calendar)
 register.inclusion_tag("eventtools/calendar/calendar.html", takes_context=True)(nav_calendar)
-register.inclusion_tag("eventtools/calendar/calendars.html", takes_context=True)(nav_calendars)
\ No newline at end of file
+register.inclusion_tag("eventtools/calendar/calendars.html", takes_context=True)(nav_calendars)
+register.simple_tag(takes_context=True)(cached_nav_calendars)
@@ -1,3 +1,4 @@
 from models import *
 from utils import *
-from views import *
\ No newline at end of file
+from views import *
+from templatetags import *
@@ -20,6 +20,14 @@ class ExampleOccurrence(OccurrenceModel):
     generated_by = models.ForeignKey(ExampleGenerator, related_name="occurrences", blank=True, null=True)
     event = models.ForeignKey(ExampleEvent, related_name="occurrences")
 
+class DatedExampleOccurrence(ExampleOccurrence):
+    # used to test that overridden ical attributes aren't shared per event.
+    class Meta:
+        proxy = True
+
+    def ical_summary(self):
+        return u"%s on %s" % (self.event, self.start.date())
+
 class ExampleExclusion(ExclusionModel):
     event = models.ForeignKey(ExampleEvent, related_name="exclusions")
 
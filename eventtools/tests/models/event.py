@@ -5,6 +5,7 @@ from eventtools.tests._fixture import fixture
 from datetime import date, time, datetime, timedelta
 from eventtools.tests._fixture import bigfixture, reload_films
 from eventtools.utils import dateranges
+from eventtools.conf import settings
 
 class TestEvents(AppTestCase):
 
@@ -225,4 +226,49 @@ class TestEvents(AppTestCase):
         e.occurrences.create(start=datetime.combine(d2, t2), _duration=25*60)
         self.ae(e.times_description(), "Times vary")
 
+    def test_occurrence_summary(self):
+        """
+        An event's status methods read from a summary of the occurrences in
+        its listing, which is cached until the occurrences change.
+        """
+        now = datetime.now().replace(microsecond=0)
+        e = ExampleEvent.eventobjects.create(title="event with a summary")
+        e.occurrences.create(start=now - timedelta(days=2), _duration=60)
+        future = e.occurrences.create(start=now + timedelta(days=2), _duration=60)
+        child = ExampleEvent.eventobjects.create(title="variation", parent=e)
+        child.occurrences.create(start=now + timedelta(days=3), _duration=60)
+        e = e.reload() #for the mptt-inserted rght value
+
+        summary = e.occurrence_summary()
+        self.ae(summary.count(), 3)
+        self.ae(summary.forthcoming_count(), 2)
+        self.ae(summary.first_start.date(), (now - timedelta(days=2)).date())
+        self.ae(summary.last_start.date(), (now + timedelta(days=3)).date())
+        self.ae(summary.start_times, set([now.time()]))
+        self.ae(e.is_finished(), False)
+        self.ae(e.status(), "")
+        self.ae(e.unavailable_status_message(), None)
+        #the event keeps its summary, so the status methods share it
+        self.assertTrue(e.occurrence_summary() is summary)
+
+        #changing occurrences invalidates the cached summary
+        future.status = settings.OCCURRENCE_STATUS_CANCELLED[0]
+        future.save()
+        self.ae(e.status(), "") # until the event is reloaded
+        e = e.reload()
+        self.ae(e.status(), "(various)")
+        self.assertFalse(e.forthcoming_is_cancelled())
+        child.occurrences.update(status=settings.OCCURRENCE_STATUS_CANCELLED[0])
+        e = e.reload()
+        self.assertFalse(e.forthcoming_is_cancelled()) # behind eventtools' back
+        ExampleEvent.touch_occurrences()
+        e = e.reload()
+        self.assertTrue(e.forthcoming_is_cancelled())
+        self.ae(e.unavailable_status_message(), "This event is CANCELLED.")
 
+        #summaries can be fetched for a queryset of events at once
+        events = list(ExampleEvent.eventobjects \
+            .filter(pk__in=[e.pk, child.pk]).with_listing_summary())
+        with self.assertNumQueries(0):
+            self.ae([x.occurrence_summary().count() for x in events], [3, 1])
+            self.ae([x.season() is not None for x in events], [True, True])
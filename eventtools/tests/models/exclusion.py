@@ -54,6 +54,26 @@ class TestExclusions(AppTestCase):
         # no excluded occurrence is (re)generated
         self.ae(self.bin_night.occurrences.filter(start = clashingtime).count(), 0)
 
+    def test_annotate_is_exclusion(self):
+        """
+        Occurrences can be annotated with whether they are exclusions in one
+        query, rather than one query per occurrence.
+        """
+        generator_fixture(self)
+
+        clashingtime = datetime(2010,1,8,10,30)
+        self.bin_night.exclusions.create(start = clashingtime)
+
+        occs = self.bin_night.occurrences.all()
+        with self.assertNumQueries(1):
+            flags = dict((o.start, o.is_exclusion()) for o in occs.annotate_is_exclusion())
+        self.ae([start for start, is_exclusion in flags.items() if is_exclusion], [clashingtime])
+        for o in occs:
+            self.ae(o.is_exclusion(), flags[o.start])
+
+        self.ae(list(ExampleEvent.eventobjects.filter(pk=self.bin_night.pk) \
+            .exclusions().values_list('start', flat=True)), [clashingtime])
+
     def test_clash(self):
         """
         If we create a one-off occurrence that clashes
@@ -9,6 +9,8 @@ from dateutil.relativedelta import relativedelta
 from django.core.urlresolvers import reverse
 from eventtools.models import Rule
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from eventtools.conf import settings
 
 class TestGenerators(AppTestCase):
     
@@ -33,7 +35,8 @@ class TestGenerators(AppTestCase):
         is continually updated.
         
         Every time a generator is saved, it does its generating.
-        Every time an event is saved, generators with a rule and no repeat_until do their generating.
+        Generators with a rule and no repeat_until are extended by the
+        extend_generators management command.
 
         A generator will not save occurrences for an event that are the same as occurrences
         already in the database (even if they were created by another generator).
@@ -45,12 +48,31 @@ class TestGenerators(AppTestCase):
 
         self.assertTrue(self.endless_generator.occurrences.count() > 52)
 
-        #test re-save event resaves 'boundless' generators, by deleting them first.
+        #test extending 'boundless' generators, by deleting their occurrences first.
         self.endless_generator.occurrences.all().delete()
         self.ae(self.endless_generator.occurrences.count(), 0)
-        self.bin_night.save()
+        ExampleGenerator.objects.filter(pk=self.endless_generator.pk).update(generated_until=None)
+        call_command('extend_generators', verbosity=0)
         self.assertTrue(self.endless_generator.occurrences.count() > 52)
 
+        #extending resumes from where generation stopped.
+        endless = ExampleGenerator.objects.get(pk=self.endless_generator.pk)
+        self.ae(endless.generated_until.date(), date.today() + settings.DEFAULT_GENERATOR_LIMIT)
+        self.ae(endless.extend(), 0)
+        horizon = date.today() + relativedelta(years=2)
+        self.assertTrue(endless.extend(horizon) > 50)
+        self.ae(endless.generated_until.date(), horizon)
+        self.ae(ExampleGenerator.objects.get(pk=endless.pk).generated_until, endless.generated_until)
+
+        #without a record of where generation stopped, extending resumes after the last occurrence.
+        count = endless.occurrences.count()
+        endless.occurrences.order_by('-start')[0].delete()
+        endless.occurrences.order_by('start')[0].delete()
+        ExampleGenerator.objects.filter(pk=endless.pk).update(generated_until=None)
+        endless = ExampleGenerator.objects.get(pk=endless.pk)
+        self.ae(endless.extend(horizon), 1)
+        self.ae(endless.occurrences.count(), count - 1)
+
         #test dupes were not created.
         
         # have we got some weekly occurrences?
@@ -555,3 +577,144 @@ class TestGenerators(AppTestCase):
         self.ae(event.occurrences.filter(generated_by__isnull=True).count(), 1)
         self.ae(event.occurrences.count(), 1)
 
+    def test_resync(self):
+        """
+        Re-saving a generator leaves the occurrences it has already generated
+        alone, and only creates the ones that are missing.
+        """
+        ids = set(self.weekly_generator.occurrences.values_list('id', flat=True))
+        self.weekly_generator.save()
+        self.ae(set(self.weekly_generator.occurrences.values_list('id', flat=True)), ids)
+
+        missing = self.weekly_generator.occurrences.all()[0]
+        missing.delete()
+        self.weekly_generator.save()
+        self.ae(self.weekly_generator.occurrences.count(), len(ids))
+        self.ae(self.weekly_generator.occurrences.filter(start=missing.start).count(), 1)
+
+    def test_resync_generators(self):
+        """
+        An event's generators can be synchronised together. Where generators
+        clash, the generator that was created first gets the occurrences.
+        """
+        self.weekly_generator.occurrences.all().delete()
+        self.bin_night.resync_generators()
+        self.ae(self.weekly_generator.occurrences.count(), 5)
+        self.ae(self.dupe_weekly_generator.occurrences.count(), 0)
+
+    def test_virtual_occurrences(self):
+        """
+        Beyond where an endless generator stops storing occurrences, its
+        occurrences can be computed on the fly, and stored when needed.
+        """
+        endless = ExampleGenerator.objects.get(pk=self.endless_generator.pk)
+        fr = endless.generated_until
+        to = fr + timedelta(days=70)
+        virtual = endless.virtual_occurrences(fr, to)
+        self.ae(len(virtual), 10)
+        self.assertTrue(all(o.is_virtual() and o.pk is None for o in virtual))
+
+        #exclusions apply
+        self.bin_night.exclusions.create(start=virtual[0].start)
+        self.ae(len(endless.virtual_occurrences(fr, to)), 9)
+
+        #stored occurrences take the place of virtual ones
+        o = virtual[1].materialise()
+        self.assertFalse(o.is_virtual())
+        self.assertTrue(o.pk is not None)
+        self.ae(len(endless.virtual_occurrences(fr, to)), 8)
+
+        #range queries can merge stored and virtual occurrences
+        qs = ExampleEvent.eventobjects.filter(pk=self.bin_night.pk).occurrences().starts_between(fr, to)
+        self.ae(len(list(qs)), 1)
+        self.ae([x.start for x in qs.with_virtual()], [x.start for x in virtual[1:]])
+
+        #re-saving the generator keeps materialised occurrences that the rule still generates
+        endless.save()
+        self.assertTrue(ExampleOccurrence.objects.filter(pk=o.pk).exists())
+
+    def test_virtual_occurrence_ties(self):
+        """
+        Stored and virtual occurrences at the same start are merged in order
+        of event pk, even where that isn't the events' order in the tree.
+        """
+        endless = ExampleGenerator.objects.get(pk=self.endless_generator.pk)
+        fr = endless.generated_until
+        to = fr + timedelta(days=14)
+        start = endless.virtual_occurrences(fr, to)[0].start
+
+        child = ExampleEvent.tree.create(title="Child event")
+        parent = ExampleEvent.tree.create(title="Parent event")
+        child.parent = parent
+        child.save() # now child comes after parent in the tree, but not by pk
+        for event in (child, parent):
+            event.occurrences.create(start=start, _duration=30)
+
+        events = ExampleEvent.eventobjects.filter(pk__in=[self.bin_night.pk, child.pk, parent.pk])
+        qs = events.occurrences().starts_between(fr, to).with_virtual()
+        keys = [(o.start, o.event_id) for o in qs]
+        self.ae([k for k in keys if k[0] == start], [(start, self.bin_night.pk), (start, child.pk), (start, parent.pk)])
+        self.ae(keys, sorted(keys))
+
+        #whatever order was asked for
+        self.ae([(o.start, o.event_id) for o in qs.order_by('-start')], keys)
+
+    def test_occurrence_range(self):
+        """
+        An OccurrenceRange of stored and virtual occurrences can be counted
+        and sliced, e.g. to paginate them.
+        """
+        endless = ExampleGenerator.objects.get(pk=self.endless_generator.pk)
+        fr = endless.generated_until - timedelta(days=35)
+        to = endless.generated_until + timedelta(days=35)
+        self.bin_night.occurrences.create(start=endless.generated_until + timedelta(days=1), _duration=30)
+
+        qs = ExampleEvent.eventobjects.filter(pk=self.bin_night.pk).occurrences()
+        r = qs.between_with_virtual(fr, to)
+        stored = list(qs.starts_between(fr, to))
+        virtual = endless.virtual_occurrences(fr, to)
+        self.assertTrue(stored and virtual)
+
+        expected = [(o.start, o.is_virtual()) for o in sorted(stored + virtual, key=lambda o: o.start)]
+        self.ae([(o.start, o.is_virtual()) for o in r], expected)
+        self.ae(r.count(), len(expected))
+        self.ae(len(r), len(expected))
+
+        for i in range(len(expected)):
+            for n in (1, 3):
+                self.ae([(o.start, o.is_virtual()) for o in r[i:i+n]], expected[i:i+n])
+        self.ae((r[-1].start, r[-1].is_virtual()), expected[-1])
+        self.assertRaises(IndexError, lambda: r[len(expected)])
+
+        #only generators that can have virtual occurrences in the range are expanded
+        index = r.generator_index()
+        self.ae(index.overlapping(fr, to), [endless])
+        self.ae(index.overlapping(fr, endless.generated_until - timedelta(days=1)), [])
+        self.ae(len(qs.between_with_virtual(fr, endless.generated_until, index).virtual), 0)
+
+    def test_occurrence_range_ties(self):
+        """
+        OccurrenceRanges page through occurrences at the same start in order
+        of event pk, even where that isn't the events' order in the tree.
+        """
+        endless = ExampleGenerator.objects.get(pk=self.endless_generator.pk)
+        fr = endless.generated_until
+        to = fr + timedelta(days=35)
+
+        child = ExampleEvent.tree.create(title="Child event")
+        parent = ExampleEvent.tree.create(title="Parent event")
+        child.parent = parent
+        child.save() # now child comes after parent in the tree, but not by pk
+        for o in endless.virtual_occurrences(fr, to):
+            for event in (child, parent):
+                event.occurrences.create(start=o.start, _duration=30)
+
+        events = ExampleEvent.eventobjects.filter(pk__in=[self.bin_night.pk, child.pk, parent.pk])
+        r = events.occurrences().between_with_virtual(fr, to)
+        expected = sorted((o.start, o.event_id) for o in
+            list(events.occurrences().starts_between(fr, to)) +
+            endless.virtual_occurrences(fr, to))
+        self.ae([(o.start, o.event_id) for o in r], expected)
+        for i in range(len(expected)):
+            for n in (1, 2, 4):
+                self.ae([(o.start, o.event_id) for o in r[i:i+n]], expected[i:i+n])
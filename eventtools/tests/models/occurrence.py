@@ -6,6 +6,12 @@ from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
 from eventtools.tests.eventtools_testapp.models import *
 from datetime import date, time, datetime, timedelta
 from eventtools.utils import datetimeify
+from eventtools.utils.dateranges import DateTester
+from eventtools.conf import settings
+from eventtools.models import Rule
+from eventtools.models.occurrence import ICalFeed
+from eventtools.utils.viewutils import response_as_ical
+from django.test.client import RequestFactory
 
 class TestOccurrences(AppTestCase):
     """
@@ -131,6 +137,185 @@ class TestOccurrences(AppTestCase):
         self.assertTrue(o.time_to_go() < timedelta(0))
         self.ae(o2.time_to_go(), timedelta(0))
 
+    def test_overlap_queries(self):
+        """
+        Occurrences store their end, so we can query for the occurrences that
+        overlap a range, or are on at a given time.
+        """
+        e = ExampleEvent.eventobjects.create(title="event with occurrences")
+        dt1 = datetime(2010,1,1,9,0)
+        o = e.occurrences.create(start=dt1, _duration=25*60)
+        o2 = e.occurrences.create(start=datetime(2010,1,2,0,0))
+        self.ae(o._end, o.end())
+        self.ae(o2._end, o2.end())
+
+        qs = e.occurrences.all()
+        self.ae(list(qs.on_at(datetime(2010,1,2,9,30))), [o])
+        self.ae(list(qs.on_at(datetime(2010,1,2,10,30))), [])
+        self.ae(list(qs.overlapping(date(2010,1,2), date(2010,1,2))), [o, o2])
+        self.ae(list(qs.overlapping(date(2010,1,3), date(2010,1,4))), [])
+        self.ae(list(qs.ends_after(datetime(2010,1,2,1,0))), [o])
+        self.ae(list(qs.starts_on(date(2010,1,2))), [o2])
+
+        # changing the duration updates the end
+        o._duration = 60
+        o.save()
+        self.ae(list(qs.on_at(datetime(2010,1,2,9,30))), [])
+
+        # generated occurrences get their generator's end, and keep it in
+        # sync when the generator changes.
+        rule = Rule.objects.create(frequency="DAILY")
+        g = e.generators.create(start=datetime(2010,2,1,18,0), _duration=90, rule=rule, repeat_until=date(2010,2,3))
+        self.ae(list(qs.on_at(datetime(2010,2,2,19,0)).values_list('start', flat=True)), [datetime(2010,2,2,18,0)])
+        g.start = datetime(2010,2,1,20,0)
+        g.save()
+        self.ae(list(qs.on_at(datetime(2010,2,2,19,0))), [])
+        self.ae(list(qs.on_at(datetime(2010,2,2,21,0)).values_list('start', flat=True)), [datetime(2010,2,2,20,0)])
+        g._duration = 30
+        g.save()
+        self.ae(list(qs.on_at(datetime(2010,2,2,21,0))), [])
+        for occurrence in g.occurrences.all():
+            self.ae(occurrence._end, occurrence.end())
+
+    def test_in_chunks(self):
+        """
+        Occurrences can be iterated a chunk at a time, in start order, eg to
+        write large feeds.
+        """
+        e1 = ExampleEvent.eventobjects.create(title="event 1")
+        e2 = ExampleEvent.eventobjects.create(title="event 2")
+        for day in range(1, 6):
+            e1.occurrences.create(start=datetime(2010,1,day,9,0))
+            e2.occurrences.create(start=datetime(2010,1,day,9,0))
+
+        qs = ExampleOccurrence.objects.filter(event__in=[e1, e2])
+        with self.assertNumQueries(4): # 10 occurrences, 3 at a time
+            chunked = list(qs.in_chunks(3))
+        self.ae(chunked, list(qs.order_by('start', 'event__id')))
+        with self.assertNumQueries(3): # a full last chunk takes one more query
+            self.ae(len(list(qs.in_chunks(5))), 10)
+
+        # chunk boundaries can fall between occurrences at the same start of
+        # events whose order in the tree isn't their pk order
+        e3 = ExampleEvent.eventobjects.create(title="event 3")
+        e1.parent = e3
+        e1.save()
+        e3.occurrences.create(start=datetime(2010,1,1,9,0))
+        qs = ExampleOccurrence.objects.filter(event__in=[e1, e2, e3])
+        expected = [(o.start, o.event_id) for o in qs.order_by('start', 'event__id')]
+        for size in (1, 2, 4):
+            self.ae([(o.start, o.event_id) for o in qs.in_chunks(size)], expected)
+
+    def test_histogram(self):
+        """
+        Occurrences can be counted by day, week or month, and by status, with
+        one query.
+        """
+        e = ExampleEvent.eventobjects.create(title="event with occurrences")
+        for day in range(1, 32):
+            e.occurrences.create(start=datetime(2011,3,day,10,0))
+            if day % 2:
+                e.occurrences.create(start=datetime(2011,3,day,18,0), status='cancelled')
+        e.occurrences.create(start=datetime(2011,4,1,10,0))
+        qs = e.occurrences.all()
+
+        with self.assertNumQueries(1):
+            days = qs.histogram(date(2011,3,1), date(2011,3,31))
+        self.ae(len(days), 31)
+        self.ae(days[date(2011,3,1)], 2)
+        self.ae(days[date(2011,3,2)], 1)
+
+        by_status = qs.histogram(date(2011,3,1), date(2011,3,2), by_status=True)
+        self.ae(by_status, {date(2011,3,1): {'': 1, 'cancelled': 1}, date(2011,3,2): {'': 1}})
+
+        months = qs.histogram(date(2011,1,1), date(2011,12,31), bucket='month')
+        self.ae(months, {date(2011,3,1): 47, date(2011,4,1): 1})
+
+        weeks = qs.histogram(date(2011,3,1), date(2011,3,31), bucket='week')
+        self.ae(sum(weeks.values()), 47)
+        self.assertTrue(all(d.weekday() == settings.FIRST_DAY_OF_WEEK for d in weeks))
+
+    def test_date_tester(self):
+        """
+        A DateTester tests dates with a query each, or, preloaded, from the
+        dates it loads, loading more as dates outside them are tested.
+        """
+        e = ExampleEvent.eventobjects.create(title="event with occurrences")
+        for day in range(0, 120, 2):
+            e.occurrences.create(start=datetime(2011,1,1,10,0) + timedelta(days=day))
+        qs = e.occurrences.all()
+        days = [date(2011,1,1) + timedelta(days=day) for day in range(120)]
+        expected = [d in set(o.start.date() for o in qs) for d in days]
+
+        tester = DateTester(qs)
+        self.ae([d in tester for d in days], expected)
+        self.assertTrue(datetime(2011,1,1,23,0) in tester)
+
+        tester = DateTester(qs, preload=True)
+        with self.assertNumQueries(1):
+            self.ae([d in tester for d in days[20:40]], expected[20:40])
+        # the loaded dates are extended a window at a time: to 25 Mar, 26 Apr
+        # and 28 May
+        with self.assertNumQueries(3):
+            self.ae([d in tester for d in days], expected)
+        with self.assertNumQueries(0):
+            self.ae([d in tester for d in reversed(days)], expected[::-1])
+
+        tester = DateTester(qs, preload=True, start=days[0], end=days[-1])
+        with self.assertNumQueries(0):
+            self.ae([d in tester for d in days], expected)
+
+        # sliced querysets are loaded whole
+        tester = DateTester(qs[:5], preload=True)
+        self.ae([d in tester for d in days[:12]], expected[:10] + [False, False])
+
+    def test_ical_etag(self):
+        """
+        The ETag of an iCal feed changes when its occurrences change in the
+        database, even if that bypasses eventtools and the version stays the
+        same.
+        """
+        e = ExampleEvent.eventobjects.create(title="event with occurrences")
+        for day in range(1, 4):
+            e.occurrences.create(start=datetime(2011,3,day,10,0))
+        qs = e.occurrences.all()
+        version = ExampleEvent.occurrences_version(e.tree_id)
+        factory = RequestFactory()
+
+        etag = response_as_ical(factory.get('/ical.ics'), qs, version)['ETag']
+        qs.filter(start=datetime(2011,3,3,10,0)).delete() # no model hooks
+        self.ae(ExampleEvent.occurrences_version(e.tree_id), version)
+        r = response_as_ical(factory.get('/ical.ics', HTTP_IF_NONE_MATCH=etag), qs, version)
+        self.ae(r.status_code, 200)
+        self.assertNotEqual(r['ETag'], etag)
+
+    def test_ics_feed(self):
+        """
+        Occurrences written to the same feed share what they have in common,
+        so a feed takes one query for the occurrences and their events.
+        """
+        e = ExampleEvent.eventobjects.create(title="Bin night")
+        for day in range(1, 11):
+            e.occurrences.create(start=datetime(2010,1,day,9,0), _duration=60)
+
+        feed = ICalFeed(RequestFactory().get('/'))
+        with self.assertNumQueries(1):
+            vevents = [
+                o.as_ics(None, feed, description_attr='no_description', url_attr='no_url')
+                for o in ExampleOccurrence.objects.filter(event=e).select_related('event')
+            ]
+        self.ae(len(vevents), 10)
+        self.assertTrue(all("SUMMARY:Bin night\r\n" in v for v in vevents))
+        self.ae(len(set(v.split("UID:")[1].split("\r\n")[0] for v in vevents)), 10)
+
+        # attributes that are overridden per occurrence aren't shared
+        self.ae(DatedExampleOccurrence._ical_event_attrs(), set(['ical_description']))
+        vevents = [
+            o.as_ics(None, feed, description_attr='no_description', url_attr='no_url')
+            for o in DatedExampleOccurrence.objects.filter(event=e).select_related('event')
+        ]
+        self.ae(len(set(v.split("SUMMARY:")[1].split("\r\n")[0] for v in vevents)), 10)
+
 """
 TODO
 
@@ -0,0 +1,25 @@
+# -*- coding: utf-8“ -*-
+from django.test import TestCase
+from eventtools.models import Rule
+from datetime import datetime
+
+class TestRules(TestCase):
+
+    def test_rrule_cache(self):
+        """
+        Compiled rrules are cached per rule and start, and a rule's cached
+        rrules are discarded when the rule is saved.
+        """
+        weekly = Rule.objects.create(frequency="WEEKLY")
+        dt1 = datetime(2011, 1, 3, 9, 0)
+        dt2 = datetime(2011, 1, 4, 9, 0)
+
+        r = weekly.get_rrule(dtstart=dt1)
+        self.assertTrue(weekly.get_rrule(dtstart=dt1) is r)
+        self.assertTrue(weekly.get_rrule(dtstart=dt2) is not r)
+        self.assertEqual(list(r[:2]), [dt1, datetime(2011, 1, 10, 9, 0)])
+
+        weekly.params = "byweekday:0,2"
+        weekly.save()
+        r = weekly.get_rrule(dtstart=dt1)
+        self.assertEqual(list(r[:2]), [dt1, datetime(2011, 1, 5, 9, 0)])
@@ -1,7 +1,7 @@
 __author__ = 'gturner'
 from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
 from eventtools.tests.eventtools_testapp.models import *
-from eventtools.models import Rule
+from eventtools.models import Rule, batched_occurrence_changes
 import datetime
 
 class TestEventTree(AppTestCase):
@@ -71,6 +71,51 @@ class TestEventTree(AppTestCase):
         self.ae(self.talk2.occurrences_in_listing().count(), 2)
         self.ae(self.talk2a.occurrences_in_listing().count(), 1)
 
+        #the opening and closing occurrences of events include those of their children.
+        self.ae(set(qs.opening_occurrences()), set(e.opening_occurrence() for e in qs))
+        self.ae(set(qs.closing_occurrences()), set(e.closing_occurrence() for e in qs))
+        self.ae(qs.filter(pk=self.talk2.pk).closing_occurrences()[0].event, self.talk2a)
+        self.ae(qs.none().opening_occurrences().count(), 0)
+
+    def test_event_save_rebuilds(self):
+        #saving an event only rebuilds the listing index if it moved in the tree,
+        #and then once for it and its children
+        rebuilds = []
+        ExampleEvent.rebuild_listing_index = classmethod(
+            lambda cls, tree_ids=None: rebuilds.append(tree_ids))
+        try:
+            tour = self.tour.reload()
+            version = ExampleEvent.occurrences_version(tour.tree_id)
+            tour.title = "Daily Tours"
+            tour.save() #cascades to glen_tour
+            self.ae(rebuilds, [])
+            #the version still changes, as the title may be in what is cached
+            self.assertNotEqual(ExampleEvent.occurrences_version(tour.tree_id), version)
+
+            self.talk2.parent = self.talk1
+            self.talk2.save()
+            self.ae(len(rebuilds), 1)
+        finally:
+            del ExampleEvent.rebuild_listing_index
+
+    def test_extreme_occurrence_ties(self):
+        #occurrences at the same start are ordered by the events' positions in
+        #the tree, as in listings, not by pk
+        festival = ExampleEvent.tree.create(title="Talks Festival")
+        self.talk2.parent = festival
+        self.talk2.save()
+        ExampleOccurrence.objects.create(event=festival, start=datetime.datetime(2011,8,30, 19,0), _duration=30)
+        ExampleOccurrence.objects.create(event=festival, start=datetime.datetime(2011,8,31, 19,0), _duration=30)
+        festival = festival.reload()
+
+        qs = ExampleEvent.eventobjects.filter(pk=festival.pk)
+        opening = qs.opening_occurrences()[0]
+        self.ae(opening, festival.opening_occurrence())
+        self.ae(opening.event, festival)
+        closing = qs.closing_occurrences()[0]
+        self.ae(closing, festival.closing_occurrence())
+        self.ae(closing.event, self.talk2a)
+
     def test_methods(self):
         #an event knows the event it is listed under
         self.ae(self.tour.listed_under(), self.tour)
@@ -80,6 +125,62 @@ class TestEventTree(AppTestCase):
         self.ae(self.talk2.listed_under(), self.talk2)
         self.ae(self.talk2a.listed_under(), self.talk2)
 
+    def test_listing_index(self):
+        #the listing index follows occurrences as they are removed and added
+        self.talk2.occurrences.all()[0].delete()
+        self.ae(self.talk2a.listed_under(), self.talk2a)
+        self.assertFalse(self.talk2.is_listed())
+        self.assertTrue(self.talk2a.is_listed())
+
+        occ = self.talk2a.occurrences.all()[0]
+        occ.event = self.talk2
+        occ.save()
+        self.ae(self.talk2a.listed_under(), self.talk2)
+        self.ae(set(ExampleEvent.eventobjects.in_listings()), set([self.talk1, self.talk2, self.tour]))
+
+        #and follows events that move in the tree
+        self.talk1.parent = self.talk2
+        self.talk1.save()
+        self.ae(self.talk1.listed_under(), self.talk2)
+        self.ae(set(ExampleEvent.eventobjects.in_listings()), set([self.talk2, self.tour]))
+
+        #it can be rebuilt from scratch
+        ExampleEvent.eventobjects.update(_has_occurrences=False, _listed_under=None)
+        ExampleEvent.rebuild_listing_index()
+        self.ae(set(ExampleEvent.eventobjects.in_listings()), set([self.talk2, self.tour]))
+        self.ae(self.glen_tour.listed_under(), self.tour)
+
+    def test_batched_occurrence_changes(self):
+        #in a batch, the listing index and version are updated once, at the end
+        version = ExampleEvent.occurrences_version(self.talk2.tree_id)
+        with batched_occurrence_changes():
+            for occ in self.talk2.occurrences.all():
+                occ.delete()
+            self.ae(self.talk2a.listed_under(), self.talk2)
+            self.ae(ExampleEvent.occurrences_version(self.talk2.tree_id), version)
+        self.ae(self.talk2a.listed_under(), self.talk2a)
+        self.assertNotEqual(ExampleEvent.occurrences_version(self.talk2.tree_id), version)
+
+        #occurrences moved between trees in a batch update both trees
+        with batched_occurrence_changes():
+            for occ in self.talk1.occurrences.all():
+                occ.event = self.glen_tour
+                occ.save()
+        self.assertFalse(self.talk1.is_listed())
+        self.ae(self.glen_tour.listed_under(), self.tour)
+
+        #if the block raises, the changes aren't done, and the error isn't hidden
+        version = ExampleEvent.occurrences_version(self.tour.tree_id)
+        def fail():
+            with batched_occurrence_changes():
+                self.tour.occurrences.all()[0].delete()
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.ae(ExampleEvent.occurrences_version(self.tour.tree_id), version)
+        with batched_occurrence_changes():
+            pass
+        self.ae(ExampleEvent.occurrences_version(self.tour.tree_id), version)
+
     def test_generation(self):
         # updating the generator for an event should not cause the regenerated Occurrences to be reassigned to that event.
         # the occurrences should be updated though, since they are still attached to the generator
@@ -0,0 +1 @@
+from calendars import *
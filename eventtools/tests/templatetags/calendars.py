@@ -0,0 +1,122 @@
+from calendar import MONDAY
+from datetime import date, datetime, timedelta
+
+from django.template import Context, Template
+
+from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
+from eventtools.tests.eventtools_testapp.models import *
+from eventtools.conf import settings
+from eventtools.templatetags.calendar import calendar, cached_nav_calendars, month_skeleton, nav_calendars, occurrence_days
+
+class TestCalendarTags(AppTestCase):
+
+    def test_nav_calendars(self):
+        """
+        nav_calendars covers the months from the first to the last occurrence,
+        highlighting the days with occurrences, with one query.
+        """
+        e = ExampleEvent.eventobjects.create(title="Daily event")
+        for day in range(0, 400, 3):
+            start = datetime(2011, 1, 30, 10, 0) + timedelta(days=day)
+            e.occurrences.create(start=start)
+            e.occurrences.create(start=start + timedelta(hours=4))
+        qs = e.occurrences.all()
+
+        with self.assertNumQueries(1):
+            days = occurrence_days(qs)
+        self.ae(days, sorted(set(o.start.date() for o in qs)))
+
+        selected = qs[1]
+        with self.assertNumQueries(1):
+            calendars = nav_calendars({}, qs, selected)['calendars']
+        self.ae(len(calendars), 15) # January 2011 to March 2012
+        cells = [d for c in calendars for week in c['weeks'] for d in week]
+        highlighted = set(d.date for d in cells if 'highlight' in d.classes)
+        self.ae(highlighted, set(days))
+        self.ae(set(d.date for d in cells if 'selected' in d.classes), set([selected.start.date()]))
+
+        # and so do histograms, which also give each day's count
+        histogram = qs.histogram(days[0], days[-1])
+        calendars = nav_calendars({}, histogram, selected)['calendars']
+        cells = [d for c in calendars for week in c['weeks'] for d in week]
+        self.ae(set(d.date for d in cells if 'highlight' in d.classes), set(days))
+        self.assertTrue(all(d.count == 2 for d in cells if d.date in histogram))
+
+        # lists of occurrences work too
+        self.ae(occurrence_days(list(qs)), days)
+        self.ae(len(nav_calendars({}, [], None)['calendars']), 1)
+
+    def test_month_skeleton(self):
+        """
+        The parts of a month's calendar that don't depend on the page are
+        built once, and each page adds its own classes and links.
+        """
+        weeks = month_skeleton(2012, 2)
+        self.assertTrue(month_skeleton(2012, 2) is weeks)
+        self.assertTrue(all(len(week) == 7 for week in weeks))
+        cells = [cell for week in weeks for cell in week]
+
+        # February 2012 runs from a Wednesday to a Wednesday, so with weeks
+        # starting on a Monday there are two leading and four trailing days.
+        lead = (2 - settings.FIRST_DAY_OF_WEEK) % 7
+        trail = (settings.FIRST_DAY_OF_WEEK + 4) % 7
+        if settings.FIRST_DAY_OF_WEEK == MONDAY:
+            self.ae((lead, trail), (2, 4))
+            self.ae(cells[:3], [
+                (date(2012, 1, 30), "2012-01-30", ("monday", "last_month")),
+                (date(2012, 1, 31), "2012-01-31", ("tuesday", "last_month")),
+                (date(2012, 2, 1), "2012-02-01", ("wednesday",)),
+            ])
+            self.ae(cells[-5:], [
+                (date(2012, 2, 29), "2012-02-29", ("wednesday",)),
+                (date(2012, 3, 1), "2012-03-01", ("thursday", "next_month")),
+                (date(2012, 3, 2), "2012-03-02", ("friday", "next_month")),
+                (date(2012, 3, 3), "2012-03-03", ("saturday", "next_month")),
+                (date(2012, 3, 4), "2012-03-04", ("sunday", "next_month")),
+            ])
+        expected = []
+        for i in range(-lead, 29 + trail):
+            d = date(2012, 2, 1) + timedelta(days=i)
+            classes = (d.strftime('%A').lower(),)
+            if d.month == 1:
+                classes += ("last_month",)
+            elif d.month == 3:
+                classes += ("next_month",)
+            expected.append((d, d.isoformat(), classes))
+        self.ae(cells, expected)
+
+        today = date.today()
+        context = calendar({}, today, date_class_fn=lambda d: ["highlight"] if d.day == 1 else [])
+        days = [d for week in context['weeks'] for d in week]
+        self.ae([d.date for d in days if 'today' in d.classes], [today])
+        self.assertTrue(all('highlight' in d.classes for d in days if d.date.day == 1))
+        self.assertTrue(all(d.date.strftime('%A').lower() in d.classes for d in days))
+
+    def test_cached_nav_calendars(self):
+        """
+        cached_nav_calendars caches the rendered calendars until the event's
+        occurrences change.
+        """
+        e = ExampleEvent.eventobjects.create(title="Event")
+        o = e.occurrences.create(start=datetime(2011, 3, 4, 10, 0))
+        html = cached_nav_calendars({}, e, o)
+        self.assertTrue('2011-03-04' in html)
+        with self.assertNumQueries(0):
+            self.ae(cached_nav_calendars({}, e, o), html)
+
+        e.occurrences.create(start=datetime(2011, 5, 6, 10, 0))
+        html2 = cached_nav_calendars({}, e, o)
+        self.assertNotEqual(html2, html)
+        self.assertTrue('2011-05' in html2)
+
+        # it renders as the nav_calendars tag does, with (but without
+        # changing) the page's context
+        e2 = ExampleEvent.eventobjects.create(title="Another event")
+        o2 = e2.occurrences.create(start=datetime(2011, 3, 4, 10, 0))
+        context = Context({'STATIC_URL': '/static/'})
+        depth = len(context.dicts)
+        html3 = cached_nav_calendars(context, e2, o2)
+        self.ae(len(context.dicts), depth)
+        uncached = Template("{% load calendar %}{% nav_calendars occurrences selected %}") \
+            .render(Context({'occurrences': e2.occurrences_in_listing(), 'selected': o2}))
+        self.ae(html3, uncached)
@@ -7,4 +7,173 @@ you can convert a list of events to a queryset
 
 String generation (human date range, datetime range)
 
-"""
\ No newline at end of file
+"""
+from datetime import date, datetime, time, timedelta
+from itertools import takewhile
+
+import vobject
+from dateutil import rrule
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import unittest
+
+from eventtools.models.rule import FREQUENCIES
+from eventtools.utils import expansion, ics, timezones
+from eventtools.utils.viewutils import response_as_ical
+
+class TestExpansion(TestCase):
+
+    @unittest.skipIf(expansion.numpy is None, "NumPy isn't installed")
+    def test_matches_dateutil(self):
+        """
+        Simple rules expand to the same starts as dateutil generates.
+        """
+        dtstart = datetime(2011, 1, 31, 10, 30)
+        until = datetime.combine(dtstart.date() + timedelta(800), time.max)
+        for frequency, params in [
+            ('DAILY', {}),
+            ('DAILY', {'byweekday': [0, 2, 4]}),
+            ('WEEKLY', {'count': 5}),
+            ('WEEKLY', {'byweekday': [1, 6]}),
+            ('MONTHLY', {}),
+            ('MONTHLY', {'bymonthday': [1, 15, -1]}),
+        ]:
+            expected = list(takewhile(lambda d: d <= until, rrule.rrule(
+                FREQUENCIES[frequency], dtstart=dtstart, **params)))
+            self.assertEqual(
+                expansion.expand_datetimes(frequency, params, dtstart, until),
+                expected)
+
+    @unittest.skipIf(expansion.numpy is None, "NumPy isn't installed")
+    def test_after(self):
+        """
+        Expansion can resume after a given datetime.
+        """
+        dtstart = datetime(2011, 1, 31, 10, 30)
+        until = datetime.combine(dtstart.date() + timedelta(800), time.max)
+        for after in [dtstart, datetime(2011, 3, 1), datetime(2012, 2, 29, 10, 30)]:
+            for frequency, params in [
+                ('DAILY', {}),
+                ('WEEKLY', {}),
+                ('WEEKLY', {'count': 20}),
+                ('WEEKLY', {'byweekday': [1, 6]}),
+                ('MONTHLY', {'bymonthday': [1, 15, -1]}),
+            ]:
+                expected = [d for d in
+                    expansion.expand_datetimes(frequency, params, dtstart, until)
+                    if d > after]
+                self.assertEqual(expansion.expand_datetimes(
+                    frequency, params, dtstart, until, after), expected)
+
+    def test_fallback(self):
+        """
+        Rules that aren't simple enough aren't expanded.
+        """
+        dtstart = datetime(2011, 1, 31, 10, 30)
+        until = datetime(2012, 1, 31)
+        self.assertEqual(expansion.expand('YEARLY', {}, dtstart, until), None)
+        self.assertEqual(expansion.expand('DAILY', {'byhour': [9, 10]}, dtstart, until), None)
+
+class TestICS(TestCase):
+
+    def test_round_trip(self):
+        """
+        VEVENTs written by eventtools.utils.ics are parsed by vobject as having
+        the values they were written with, including text that needs escaping
+        and lines that need folding.
+        """
+        summary = u"Bin night; bring bins, \\ recycling\nand green waste"
+        description = u"Caf\xe9 \u2013 " * 30
+        dtstamp = datetime(2012, 1, 1, 12, 0)
+        for dtstart, dtend in [
+            (datetime(2012, 1, 2, 10, 30), datetime(2012, 1, 2, 11, 30)),
+            (date(2012, 1, 2), date(2012, 1, 2)),
+        ]:
+            text = "".join([
+                ics.calendar_head(u"Events, etc.", u"All the events"),
+                ics.vevent(u"occurrence-1-20120102T103000@example.com", dtstamp,
+                    dtstart, dtend, summary=summary, description=description,
+                    url=u"http://example.com/events/bin-night/1/",
+                    location=u"Kerb", geo=u"151.2;-33.9", cancelled=True),
+                ics.calendar_tail(),
+            ])
+            for line in text.split("\r\n"):
+                self.assertTrue(len(line) <= 75)
+                line.decode('utf-8')
+
+            ical = vobject.readOne(text.decode('utf-8'))
+            self.assertEqual(ical.x_wr_calname.value, u"Events, etc.")
+            vevent = ical.vevent
+            self.assertEqual(vevent.uid.value, u"occurrence-1-20120102T103000@example.com")
+            if isinstance(dtstart, datetime):
+                utc = vobject.icalendar.utc
+                self.assertEqual(vevent.dtstart.value, dtstart.replace(tzinfo=utc))
+                self.assertEqual(vevent.dtend.value, dtend.replace(tzinfo=utc))
+            else:
+                self.assertEqual(vevent.dtstart.value, dtstart)
+                self.assertEqual(vevent.dtend.value, dtend)
+            self.assertEqual(vevent.summary.value, summary)
+            self.assertEqual(vevent.description.value, description)
+            self.assertEqual(vevent.url.value, u"http://example.com/events/bin-night/1/")
+            self.assertEqual(vevent.location.value, u"Kerb")
+            self.assertEqual(vevent.geo.value, u"151.2;-33.9")
+            self.assertEqual(vevent.status.value, u"CANCELLED")
+
+    def test_utc(self):
+        """
+        Aware datetimes are written in UTC.
+        """
+        from dateutil.tz import tzoffset
+        dt = datetime(2012, 1, 2, 10, 30, tzinfo=tzoffset(None, 11 * 60 * 60))
+        self.assertEqual(ics.format_datetime(dt), "20120101T233000Z")
+        self.assertEqual(ics.format_datetime(datetime(2012, 1, 2, 10, 30)), "20120102T103000Z")
+
+class TestICalResponse(TestCase):
+
+    def test_conditional_get(self):
+        """
+        iCal feeds with a version have an ETag, which requests can be
+        conditional on, and are cached until the version changes.
+        """
+        factory = RequestFactory()
+        version = (1325376000.5,)
+        r = response_as_ical(factory.get('/ical.ics'), [], version)
+        self.assertEqual(r.status_code, 200)
+        body = "".join(r)
+        self.assertTrue(body.startswith("BEGIN:VCALENDAR"))
+
+        # there's no Last-Modified, as the feed changes with the date too
+        self.assertFalse(r.has_header('Last-Modified'))
+
+        r2 = response_as_ical(factory.get('/ical.ics', HTTP_IF_NONE_MATCH=r['ETag']), [], version)
+        self.assertEqual(r2.status_code, 304)
+        self.assertEqual(r2['ETag'], r['ETag'])
+
+        # the feed was cached as it was written, so isn't written again
+        r3 = response_as_ical(factory.get('/ical.ics'), None, version)
+        self.assertEqual("".join(r3), body)
+
+        # other ranges, or a new version, have a different ETag
+        r4 = response_as_ical(factory.get('/ical.ics?startdate=2012-01-01'), [], version)
+        self.assertNotEqual(r4['ETag'], r['ETag'])
+        r5 = response_as_ical(factory.get('/ical.ics', HTTP_IF_NONE_MATCH=r['ETag']), [], (1325376100.0,))
+        self.assertEqual(r5.status_code, 200)
+        self.assertNotEqual(r5['ETag'], r['ETag'])
+
+class TestTimezones(TestCase):
+
+    def test_to_utc_many(self):
+        """
+        Converting many datetimes to UTC at once gives the same results as
+        converting them one at a time, across daylight saving changes.
+        """
+        for name in ['Australia/Sydney', 'Europe/London', 'UTC']:
+            tz = timezones.get_zone(name)
+            self.assertTrue(timezones.get_zone(name) is tz)
+            first = datetime(2011, 1, 1)
+            datetimes = [first + timedelta(hours=h) for h in range(0, 2 * 365 * 24, 5)]
+            # unsorted, and with repeats
+            datetimes = datetimes[::-1] + datetimes[::3]
+            self.assertEqual(timezones.to_utc_many(datetimes, tz),
+                [timezones.to_utc(dt, tz) for dt in datetimes])
+        self.assertEqual(timezones.to_utc_many([], tz), [])
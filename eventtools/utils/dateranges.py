@@ -65,16 +65,54 @@ class DateTester(object):
     if date.today() in date_tester_object:
         ...
     
+    By default each test is a query. With preload=True, the distinct dates of
+    the occurrences between start and end (or, if they aren't given, within
+    `window` of the first date tested) are loaded with one query, and tests are
+    answered from them. Testing a date outside the loaded dates loads the
+    dates between it (give or take `window`) and the loaded ones, so a run of
+    tests over nearby dates - as in a calendar - costs a query or two in all.
     """
-    def __init__(self, occurrence_qs):
+    def __init__(self, occurrence_qs, preload=False, start=None, end=None,
+        window=timedelta(31)):
         self.occurrence_qs = occurrence_qs
+        self.preload = preload
+        self.window = window
+        self.dates = set()
+        self.start = self.end = None # the range of loaded dates, inclusive
+        if preload and start is not None and end is not None:
+            self._load(start, end)
         
     def __contains__(self, d):
-        occs = self.occurrence_qs.starts_on(d)
-        return occs
-            
+        if isinstance(d, datetime):
+            d = d.date()
+        if not self.preload:
+            return self.occurrence_qs.starts_on(d).exists()
+        if self.start is None:
+            self._load(d - self.window, d + self.window)
+        elif d < self.start:
+            self._load(d - self.window, self.start - timedelta(1))
+        elif d > self.end:
+            self._load(self.end + timedelta(1), d + self.window)
+        return d in self.dates
+
+    def _load(self, d1, d2):
+        """
+        Adds the dates of the occurrences between d1 and d2 (inclusive) to the
+        loaded dates.
+        """
+        qs = self.occurrence_qs
+        if qs.query.can_filter():
+            self.dates.update(
+                d.date() if isinstance(d, datetime) else d
+                for d in qs.starts_between(d1, d2).dates('start', 'day')
+            )
+            self.start = d1 if self.start is None else min(self.start, d1)
+            self.end = d2 if self.end is None else max(self.end, d2)
+        else:
+            # a sliced queryset can't be filtered further, so load it all.
+            self.dates.update(o.start.date() for o in qs)
+            self.start, self.end = date.min, date.max
 
-        
 def xdaterange(d1, d2):
     delta_range = range((d2-d1).days)
     for td in delta_range:
@@ -0,0 +1,123 @@
+"""
+Fast expansion of simple repetition rules into start datetimes.
+
+Rather than stepping a dateutil iterator one datetime at a time, this uses
+NumPy (if it is installed) to compute all the starts up to a limit in one go.
+
+Only the common cases are handled: DAILY and WEEKLY rules with no params or
+plain 'byweekday' params, and MONTHLY rules with no params or plain
+'bymonthday' params, each optionally with a 'count'. For anything else
+(including complex rules, and when NumPy isn't installed) the functions here
+return None, and callers should fall back to dateutil.
+"""
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def expand(frequency, params, dtstart, until, after=None):
+    """
+    Returns a NumPy datetime64 array of the starts of a rule with the given
+    frequency and params (as returned by Rule.get_params), from dtstart up to
+    and including until.
+
+    If after is given, only the starts after it are returned, and (unless the
+    rule has a count) the starts before it aren't computed at all.
+    """
+    if numpy is None or dtstart.tzinfo is not None:
+        return None
+
+    params = dict(params)
+    count = params.pop('count', None)
+    # counting needs every start from dtstart.
+    skip_to = after if count is None else None
+    if frequency in ('DAILY', 'WEEKLY'):
+        days = _expand_weekdays(
+            frequency, params.pop('byweekday', None), dtstart, until, skip_to)
+    elif frequency == 'MONTHLY':
+        days = _expand_monthdays(
+            params.pop('bymonthday', None), dtstart, until, skip_to)
+    else:
+        return None
+    if days is None or params:
+        return None
+
+    time_of_day = dtstart - datetime.datetime.combine(
+        dtstart.date(), datetime.time.min)
+    starts = days.astype('datetime64[us]') + numpy.timedelta64(time_of_day)
+    starts = starts[starts <= numpy.datetime64(until)]
+    if count is not None:
+        starts = starts[:count]
+    if after is not None:
+        starts = starts[starts > numpy.datetime64(after)]
+    return starts
+
+def expand_datetimes(frequency, params, dtstart, until, after=None):
+    """
+    As expand(), but returns a list of datetimes.
+    """
+    starts = expand(frequency, params, dtstart, until, after)
+    if starts is None:
+        return None
+    return starts.astype(object).tolist()
+
+def _as_list(param):
+    if param is None:
+        return None
+    if isinstance(param, (list, tuple)):
+        return list(param)
+    return [param]
+
+def _day_range(dtstart, until, step=1, skip_to=None):
+    first = numpy.datetime64(dtstart.date(), 'D')
+    if skip_to is not None and skip_to > dtstart:
+        # skip the whole steps before skip_to's day
+        days = (skip_to.date() - dtstart.date()).days
+        first += numpy.timedelta64(days - days % step, 'D')
+    last = numpy.datetime64(until.date(), 'D')
+    return numpy.arange(first, last + numpy.timedelta64(1, 'D'), step)
+
+def _expand_weekdays(frequency, byweekday, dtstart, until, skip_to=None):
+    weekdays = _as_list(byweekday)
+    if weekdays is None:
+        if frequency == 'DAILY':
+            return _day_range(dtstart, until, skip_to=skip_to)
+        return _day_range(dtstart, until, 7, skip_to)
+
+    if [wd for wd in weekdays if wd not in range(7)]:
+        return None
+    # With an interval of 1, both frequencies give every day (from dtstart)
+    # that falls on one of the weekdays. 1 Jan 1970 was a Thursday (3).
+    wanted = numpy.zeros(7, dtype=bool)
+    wanted[weekdays] = True
+    days = _day_range(dtstart, until, skip_to=skip_to)
+    return days[wanted[(days.astype('int64') + 3) % 7]]
+
+def _expand_monthdays(bymonthday, dtstart, until, skip_to=None):
+    monthdays = _as_list(bymonthday) or [dtstart.day]
+    if [md for md in monthdays if not md or abs(md) > 31]:
+        return None
+
+    first = dtstart
+    if skip_to is not None and skip_to > dtstart:
+        first = skip_to
+    months = numpy.arange(
+        numpy.datetime64(first.date(), 'M'),
+        numpy.datetime64(until.date(), 'M') + numpy.timedelta64(1, 'M'),
+    )
+    month_starts = months.astype('datetime64[D]')
+    next_month_starts = (months + 1).astype('datetime64[D]')
+    days_in_months = (next_month_starts - month_starts).astype('int64')
+
+    days = []
+    for md in monthdays:
+        # months that don't have the day are skipped, as dateutil does.
+        valid = abs(md) <= days_in_months
+        if md > 0:
+            days.append((month_starts + (md - 1))[valid])
+        else:
+            days.append((next_month_starts + md)[valid])
+    days = numpy.unique(numpy.concatenate(days))
+    return days[days >= numpy.datetime64(dtstart.date(), 'D')]
@@ -0,0 +1,106 @@
+"""
+A fast iCalendar (RFC 5545) writer for the properties eventtools puts in its
+feeds (see OccurrenceModel.as_ics), which is much quicker than building and
+serializing vobject components.
+
+Everything is returned as UTF-8 encoded, CRLF-terminated lines, folded at 75
+octets. It doesn't need Django.
+"""
+import datetime
+
+CRLF = "\r\n"
+LINE_LENGTH = 75
+PRODID = "-//glamkit-eventtools//NONSGML Events//EN"
+
+def escape_text(value):
+    """
+    Escapes a TEXT property value.
+    """
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,") \
+        .replace("\r\n", "\\n").replace("\n", "\\n").replace("\r", "\\n")
+
+def fold(line):
+    """
+    Returns a UTF-8 encoded content line, with CRLF, folded into lines of at
+    most 75 octets (not splitting multi-byte characters).
+    """
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    if len(line) <= LINE_LENGTH:
+        return line + CRLF
+
+    parts = []
+    start = 0
+    limit = LINE_LENGTH
+    while len(line) - start > limit:
+        end = start + limit
+        while ord(line[end]) & 0xC0 == 0x80: # a UTF-8 continuation byte
+            end -= 1
+        parts.append(line[start:end])
+        start = end
+        limit = LINE_LENGTH - 1 # continuation lines start with a space
+    parts.append(line[start:])
+    return (CRLF + " ").join(parts) + CRLF
+
+def format_date(d):
+    return "%04d%02d%02d" % (d.year, d.month, d.day)
+
+def format_datetime(dt):
+    """
+    Formats a datetime in UTC. Naive datetimes are taken to be in UTC already.
+    """
+    offset = dt.utcoffset()
+    if offset:
+        dt = dt.replace(tzinfo=None) - offset
+    return "%04d%02d%02dT%02d%02d%02dZ" % (
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+
+def date_property(name, value):
+    if isinstance(value, datetime.datetime):
+        return fold("%s:%s" % (name, format_datetime(value)))
+    return fold("%s;VALUE=DATE:%s" % (name, format_date(value)))
+
+def text_property(name, value):
+    return fold(u"%s:%s" % (name, escape_text(value)))
+
+def calendar_head(calname, caldesc, method='PUBLISH'):
+    return "".join([
+        fold("BEGIN:VCALENDAR"),
+        fold("VERSION:2.0"),
+        fold("PRODID:%s" % PRODID),
+        fold("METHOD:%s" % method), # IE/Outlook needs this
+        text_property("X-WR-CALNAME", calname),
+        text_property("X-WR-CALDESC", caldesc),
+    ])
+
+def calendar_tail():
+    return fold("END:VCALENDAR")
+
+def vevent(uid, dtstamp, dtstart, dtend, summary=None, description=None,
+    url=None, location=None, geo=None, cancelled=False):
+    """
+    Returns a VEVENT. dtstart and dtend are dates (for all-day events) or
+    datetimes, and geo is a string, as it is to be written.
+    """
+    lines = [
+        fold("BEGIN:VEVENT"),
+        text_property("UID", uid),
+        date_property("DTSTAMP", dtstamp),
+        date_property("DTSTART", dtstart),
+        date_property("DTEND", dtend),
+    ]
+    if cancelled:
+        lines.append(fold("METHOD:CANCEL"))
+        lines.append(fold("STATUS:CANCELLED"))
+    if summary:
+        lines.append(text_property("SUMMARY", summary))
+    if description:
+        lines.append(text_property("DESCRIPTION", description))
+    if url:
+        lines.append(fold(u"URL:%s" % url))
+    if location:
+        lines.append(text_property("LOCATION", location))
+    if geo:
+        lines.append(fold(u"GEO:%s" % geo))
+    lines.append(fold("END:VEVENT"))
+    return "".join(lines)
@@ -0,0 +1,49 @@
+"""
+A small, thread-safe, least-recently-used cache, for memoising values that are
+expensive to build, once per process.
+"""
+from collections import OrderedDict
+from threading import Lock
+
+class LRUCache(object):
+    """
+    Holds up to `size` values. When full, setting a value evicts the value
+    that was least recently got or set. A size of 0 disables the cache.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        if not self.size:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def discard_if(self, predicate):
+        """
+        Removes the values whose keys match predicate(key).
+        """
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,77 @@
+"""
+Backend-specific SQL for the date arithmetic that the ORM can't express
+(F() expressions can't add a timedelta to a datetime column, or extract the
+time of day).
+
+Each *_sql function returns None if the database backend isn't supported, so that
+callers can fall back to doing the work in Python.
+"""
+import datetime
+
+from django.db import connection
+
+def shift_datetime_sql(column, seconds):
+    """
+    Returns SQL for the (already quoted) datetime `column`, shifted by a whole
+    number of seconds.
+    """
+    seconds = int(seconds)
+    vendor = getattr(connection, 'vendor', None)
+    if vendor == 'sqlite':
+        return "datetime(%s, '%+d seconds')" % (column, seconds)
+    if vendor == 'postgresql':
+        return "(%s + interval '%d seconds')" % (column, seconds)
+    if vendor == 'mysql':
+        return "DATE_ADD(%s, INTERVAL %d SECOND)" % (column, seconds)
+    return None
+
+def time_sql(column):
+    """
+    Returns SQL for the time of day of the (already quoted) datetime `column`.
+    Convert the values it selects with time_from_db().
+    """
+    vendor = getattr(connection, 'vendor', None)
+    if vendor == 'sqlite':
+        return "time(%s)" % column
+    if vendor == 'postgresql':
+        return "CAST(%s AS time)" % column
+    if vendor == 'mysql':
+        return "TIME(%s)" % column
+    return None
+
+def date_sql(column):
+    """
+    Returns SQL for the date of the (already quoted) datetime `column`.
+    Convert the values it selects with date_from_db().
+    """
+    vendor = getattr(connection, 'vendor', None)
+    if vendor == 'sqlite':
+        return "date(%s)" % column
+    if vendor == 'postgresql':
+        return "CAST(%s AS date)" % column
+    if vendor == 'mysql':
+        return "DATE(%s)" % column
+    return None
+
+def date_from_db(value):
+    """
+    Returns a datetime.date for a value selected with date_sql(), which
+    comes back as a string from SQLite.
+    """
+    if value is None or isinstance(value, datetime.date) \
+        and not isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return datetime.datetime.strptime(value[:10], "%Y-%m-%d").date()
+
+def time_from_db(value):
+    """
+    Returns a datetime.time for a value selected with time_sql(), which
+    comes back as a string from SQLite and as a timedelta from MySQL.
+    """
+    if value is None or isinstance(value, datetime.time):
+        return value
+    if isinstance(value, datetime.timedelta):
+        return (datetime.datetime.min + value).time()
+    return datetime.datetime.strptime(value[:8], "%H:%M:%S").time()
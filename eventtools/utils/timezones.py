@@ -0,0 +1,90 @@
+"""
+Fast conversion of naive local datetimes to UTC, for iCal feeds.
+
+Looking up a zone with gettz() reads its zoneinfo file, so get_zone() keeps
+the zones it has looked up. And rather than asking the zone for the offset of
+every datetime, to_utc_many() finds the runs of datetimes with the same
+offset (between daylight saving changes) by probing a few of them, and
+subtracts each run's offset.
+"""
+import datetime
+from bisect import bisect_right
+
+from dateutil.tz import gettz
+
+# No zone changes its offset more than once in this long, so each window of
+# datetimes this long needs at most one bisection.
+WINDOW = datetime.timedelta(days=7)
+
+_zones = {}
+
+def get_zone(name):
+    """
+    Returns gettz(name), looking each zone up only once.
+    """
+    try:
+        return _zones[name]
+    except KeyError:
+        zone = _zones[name] = gettz(name)
+        return zone
+
+def utc_offset(dt, tz):
+    return tz.utcoffset(dt.replace(tzinfo=tz))
+
+def to_utc(dt, tz):
+    """
+    Returns the naive datetime dt, taken to be in tz, as a naive UTC datetime.
+    """
+    return dt - utc_offset(dt, tz)
+
+def _runs(values, offset_at):
+    """
+    Yields (i, j, offset) for each run values[i:j] of the sorted naive
+    datetimes with the same offset. offset_at(k) returns the offset of
+    values[k].
+    """
+    n = len(values)
+    i = 0
+    while i < n:
+        offset = offset_at(i)
+        try:
+            window_end = values[i] + WINDOW
+        except OverflowError:
+            window_end = datetime.datetime.max
+        j = bisect_right(values, window_end, i)
+        if offset_at(j - 1) != offset:
+            # the offset changes once in the window: bisect for where.
+            lo, hi = i, j - 1
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if offset_at(mid) == offset:
+                    lo = mid
+                else:
+                    hi = mid
+            j = hi
+        yield i, j, offset
+        i = j
+
+def to_utc_many(datetimes, tz):
+    """
+    Returns a list of the naive datetimes, taken to be in tz, as naive UTC
+    datetimes - the same as [to_utc(dt, tz) for dt in datetimes], but asking
+    the zone for only a few offsets.
+    """
+    n = len(datetimes)
+    order = sorted(range(n), key=datetimes.__getitem__)
+    values = [datetimes[k] for k in order]
+
+    offsets = {} # bisection revisits the ends of windows
+    def offset_at(k):
+        try:
+            return offsets[k]
+        except KeyError:
+            offset = offsets[k] = utc_offset(values[k], tz)
+            return offset
+
+    result = [None] * n
+    for i, j, offset in _runs(values, offset_at):
+        for k in range(i, j):
+            result[order[k]] = values[k] - offset
+    return result
@@ -1,9 +1,18 @@
+from django.core.cache import cache
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
-from django.http import HttpResponse
+from django.db.models import Count, Max
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+try:
+    from django.http import StreamingHttpResponse
+except ImportError: # Django < 1.5 streams iterators given to HttpResponse
+    StreamingHttpResponse = HttpResponse
 from eventtools.conf import settings
+from eventtools.models.occurrence import ICalFeed
+from eventtools.utils import ics
 from datetime import date
+import hashlib
 from dateutil import parser as dateparser
-from vobject import iCalendar
 
 
 def paginate(request, pool):
@@ -47,20 +56,112 @@ def parse_GET_date(GET={}):
             
     return fr, to
     
-def response_as_ical(request, occurrences):
-    ical = iCalendar()
-    ical.add('X-WR-CALNAME').value = settings.ICAL_CALNAME
-    ical.add('X-WR-CALDESC').value = settings.ICAL_CALDESC
-    ical.add('method').value = 'PUBLISH'  # IE/Outlook needs this
-
-    if hasattr(occurrences, '__iter__'):
-        for occ in occurrences:
-            ical = occ.as_icalendar(ical, request)
+def iter_ical(request, occurrences):
+    """
+    Yields an iCalendar of the occurrences, one VEVENT at a time (see
+    OccurrenceModel.as_ics). Querysets are fetched ICAL_CHUNK_SIZE
+    occurrences at a time, so memory use doesn't grow with the size of the
+    feed.
+    """
+    yield ics.calendar_head(settings.ICAL_CALNAME, settings.ICAL_CALDESC)
+
+    if hasattr(occurrences, 'chunks'):
+        chunks = occurrences.select_related('event') \
+            .chunks(settings.ICAL_CHUNK_SIZE)
+    elif hasattr(occurrences, '__iter__'):
+        chunks = [list(occurrences)]
     else:
-        ical = occurrences.as_icalendar(ical, request)
-    
-    icalstream = ical.serialize()
-    response = HttpResponse(icalstream, mimetype='text/calendar')
+        chunks = [[occurrences]]
+    feed = ICalFeed(request)
+    for chunk in chunks:
+        feed.convert_times(chunk)
+        for occ in chunk:
+            yield occ.as_ics(request, feed)
+
+    yield ics.calendar_tail()
+
+def _cache_as_written(key, chunks):
+    """
+    Yields the chunks, and caches them joined together once they have all
+    been written, unless there are more than ICAL_CACHE_MAX_SIZE bytes.
+    """
+    written = []
+    size = 0
+    for chunk in chunks:
+        if written is not None:
+            size += len(chunk)
+            if size > settings.ICAL_CACHE_MAX_SIZE:
+                written = None
+            else:
+                written.append(chunk)
+        yield chunk
+    if written is not None:
+        cache.set(key, "".join(written), settings.ICAL_CACHE_TIMEOUT)
+
+def _ical_response(response):
     response['Filename'] = 'events.ics'  # IE needs this
     response['Content-Disposition'] = 'attachment; filename=events.ics'
     return response
+
+def _not_modified(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in parse_etags(if_none_match)
+
+def _stored_state(occurrences):
+    """
+    Returns a cheap aggregate of the occurrences in the database - their
+    number, highest pk and latest end - which changes when occurrences are
+    added or deleted (or the latest one moves) behind eventtools' back, eg
+    with QuerySet.delete(), loaddata or in another process, which doesn't
+    change the occurrences_version().
+
+    It doesn't notice other changes to stored fields, eg by
+    QuerySet.update(status=...) or raw SQL, so call
+    EventModel.touch_occurrences() after those.
+    """
+    if not hasattr(occurrences, 'aggregate'):
+        return None
+    state = occurrences.aggregate(
+        n=Count('pk'), last_pk=Max('pk'), last_end=Max('_end'))
+    return state['n'], state['last_pk'], state['last_end']
+
+def response_as_ical(request, occurrences, version=None):
+    """
+    Returns an iCalendar of the occurrences.
+
+    If a version is given (eg EventModel.occurrences_version()), which
+    changes whenever the occurrences would be written differently, it is
+    used with an aggregate of the occurrences in the database for the ETag
+    of the response, so that polling calendar apps get 304 Not Modified
+    until either changes, and the calendar is cached until then.
+
+    There is no Last-Modified, as the feed can change without either
+    changing, when the date does.
+    """
+    if version is None:
+        return _ical_response(StreamingHttpResponse(
+            iter_ical(request, occurrences), content_type='text/calendar'))
+
+    # The feed also depends on the URL (for the date range, and the links)
+    # and the date (for the default range).
+    etag = hashlib.md5(repr((
+        version, _stored_state(occurrences), request.is_secure(),
+        request.get_host(), request.get_full_path(), date.today(),
+    ))).hexdigest()
+
+    if _not_modified(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        key = 'eventtools.ical.%s' % etag
+        body = cache.get(key)
+        if body is None:
+            response = _ical_response(StreamingHttpResponse(
+                _cache_as_written(key, iter_ical(request, occurrences)),
+                content_type='text/calendar'))
+        else:
+            response = _ical_response(
+                HttpResponse(body, content_type='text/calendar'))
+    response['ETag'] = quote_etag(etag)
+    return response
@@ -7,6 +7,7 @@ from django.template.context import RequestContext
 from django.utils.safestring import mark_safe
 
 from eventtools.conf import settings
+from eventtools.utils import dayify
 from eventtools.utils.pprint_timespan import humanized_date_range
 from eventtools.utils.viewutils import paginate, response_as_ical, parse_GET_date
 
@@ -79,17 +80,27 @@ class EventViews(object):
 
 
     def event_ical(self, request, event_slug):
-        event_context = self._event_context(request, event_slug)
-        return response_as_ical(request, event_context['occurrence_pool'])
+        event = get_object_or_404(self.event_qs, slug=event_slug)
+        return response_as_ical(request,
+            event.occurrences_in_listing().select_related('event'),
+            version=event.occurrences_version(event.tree_id))
 
     #occurrence_list
-    def _occurrence_list_context(self, request, qs):
+    def _occurrence_pool(self, request, qs):
+        """
+        Returns the first day of the range of dates in the request, and the
+        occurrences of qs in it.
+        """
         fr, to = parse_GET_date(request.GET)
 
         if to is None:
             occurrence_pool = qs.after(fr)
         else:
             occurrence_pool = qs.between(fr, to)
+        return fr, occurrence_pool.select_related('event')
+
+    def _occurrence_list_context(self, request, qs):
+        fr, occurrence_pool = self._occurrence_pool(request, qs)
 
         pageinfo = paginate(request, occurrence_pool)
 
@@ -110,9 +121,10 @@ class EventViews(object):
         return render_to_response(template, context)
     
     def occurrence_list_ical(self, request):
-        occurrence_list_context = self._occurrence_list_context(request, self.occurrence_qs)
-        pool = occurrence_list_context['occurrence_pool']
-        return response_as_ical(request, pool)
+        # not _occurrence_list_context(), as the feed isn't paginated
+        fr, pool = self._occurrence_pool(request, self.occurrence_qs)
+        return response_as_ical(request, pool,
+            version=self.event_qs.model.occurrences_version())
 
     def on_date(self, request, year, month, day):
         template = 'eventtools/occurrence_list.html'
@@ -138,12 +150,13 @@ class EventViews(object):
 
     def signage_on_date(self, request, year, month, day):
         """
-        Render a signage view of events that occur on a given day.
+        Render a signage view of events that are on at any time on a given
+        day, including those that started earlier and are still in progress.
         """
         template = 'eventtools/signage_on_date.html'
         dt = datetime.date(int(year), int(month), int(day))
         today = datetime.date.today()
-        occurrences = self.occurrence_qs.starts_on(dt)
+        occurrences = self.occurrence_qs.overlapping(*dayify(dt))
 
         context = RequestContext(request)
         context['occurrence_pool'] = occurrences